@@ -1,5 +1,96 @@
+import hashlib
 import logging
-from network import send_email
+import os
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
+
+# Files at or above the threshold are split into parts and uploaded in parallel by boto3
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MIN_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+MAX_MULTIPART_CHUNKSIZE = 64 * 1024 * 1024
+MAX_CONCURRENCY = 8
+
+# Error codes that will not go away by retrying (bad credentials, missing bucket or permissions)
+FATAL_S3_ERROR_CODES = {'AccessDenied', 'AllAccessDisabled', 'InvalidAccessKeyId', 'SignatureDoesNotMatch',
+                        'NoSuchBucket', 'AccountProblem', '403', '404'}
+
+
+def get_s3_key(file_name, year, month):
+    """
+    Builds the key of a file in the S3 bucket.
+
+    Args:
+    file_name (str): The name of the file.
+    year (str): The year the file was captured (e.g., '2024').
+    month (str): The month the file was captured (e.g., 'August').
+
+    Returns:
+    str: The S3 key in the form "<hash prefix>/<year>/<month>/<file_name>".
+
+    S3 scales request throughput per key prefix, so with a plain "<year>/<month>/" layout a backlog upload
+    sends all of its requests to a single prefix and gets throttled. The two hex characters of the MD5 of the
+    file name spread the keys evenly over 256 prefixes, while the key can still be derived from the file name alone.
+
+    Example:
+    >>> get_s3_key('image_capture_2024-08-09_14-30-00.jpg', '2024', 'August')
+    'ac/2024/August/image_capture_2024-08-09_14-30-00.jpg'
+    """
+    hash_prefix = hashlib.md5(file_name.encode()).hexdigest()[:2]
+    return f"{hash_prefix}/{year}/{month}/{file_name}"
+
+
+def get_multipart_chunksize(file_size):
+    """
+    Calculates the part size used for a multipart upload of a file of the given size.
+
+    Args:
+    file_size (int): The size of the file in bytes.
+
+    Returns:
+    int: The part size in bytes, between 16 MiB and 64 MiB.
+
+    The part size grows with the file so that large videos need fewer requests, while still
+    leaving enough parts to upload in parallel.
+    """
+    return min(MAX_MULTIPART_CHUNKSIZE, max(MIN_MULTIPART_CHUNKSIZE, file_size // 32))
+
+
+def get_transfer_config(file_size):
+    """
+    Builds the boto3 transfer configuration for uploading a file of the given size.
+
+    Args:
+    file_size (int): The size of the file in bytes.
+
+    Returns:
+    boto3.s3.transfer.TransferConfig: The transfer configuration with part size and concurrency tuned to the file.
+    """
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                          multipart_chunksize=get_multipart_chunksize(file_size),
+                          max_concurrency=min(MAX_CONCURRENCY, file_size // MIN_MULTIPART_CHUNKSIZE + 1),
+                          use_threads=True)
+
+
+def is_fatal_s3_error(error):
+    """
+    Checks whether an S3 upload error is permanent, so that retrying the upload is pointless.
+
+    Args:
+    error (Exception): The exception raised by the upload.
+
+    Returns:
+    bool: True for missing or invalid credentials, denied access or a missing bucket, False otherwise.
+    """
+    # upload_file wraps the ClientError of the failed request in an S3UploadFailedError
+    if isinstance(error, S3UploadFailedError) and isinstance(error.__context__, ClientError):
+        error = error.__context__
+
+    if isinstance(error, (NoCredentialsError, PartialCredentialsError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in FATAL_S3_ERROR_CODES
+    return False
 
 
 def upload_to_s3(local_file_path, bucket_name, s3_file_name, s3_client):
@@ -15,39 +106,47 @@ def upload_to_s3(local_file_path, bucket_name, s3_file_name, s3_client):
     Returns:
     tuple: A tuple containing:
         - bool: True if the upload is successful, False otherwise.
-        - str or None: The MD5 checksum (ETag) of the uploaded file if successful, None otherwise.
+        - str or None: The ETag of the uploaded file if successful, None otherwise.
+        - Exception or None: The error that made the upload fail, None if successful.
 
     This function uploads a file to a specified S3 bucket and logs the result of the operation.
-    It retrieves the ETag (MD5 checksum) of the uploaded file from the response, which can be used for verifying the upload.
+    Files smaller than `MULTIPART_THRESHOLD` (e.g. images) are uploaded with a single PUT request,
+    larger files are uploaded as a parallel multipart upload with a part size based on the file size.
+    The ETag of the uploaded object is fetched afterwards and can be used for verifying the upload. For single part
+    uploads it is the MD5 checksum of the file, for multipart uploads it has the form "<md5 of part digests>-<parts>".
 
     Example:
     >>> upload_to_s3('/path/to/file.txt', 'my-bucket', 'path/in/bucket/file.txt', s3_client)
-    (True, 'd41d8cd98f00b204e9800998ecf8427e')
+    (True, 'd41d8cd98f00b204e9800998ecf8427e', None)
     """
     try:
-        # Open the local file in binary read mode
-        with open(local_file_path, "rb") as data:
-            # Upload the file to S3
-            response = s3_client.put_object(Bucket=bucket_name, Key=s3_file_name, Body=data)
+        file_size = os.path.getsize(local_file_path)
+
+        if file_size < MULTIPART_THRESHOLD:
+            # Upload small files in a single request to avoid the multipart overhead
+            with open(local_file_path, "rb") as data:
+                response = s3_client.put_object(Bucket=bucket_name, Key=s3_file_name, Body=data)
+        else:
+            # Upload large files as a parallel multipart upload
+            s3_client.upload_file(local_file_path, bucket_name, s3_file_name,
+                                  Config=get_transfer_config(file_size))
+
+            # upload_file does not return a response, so fetch the ETag from the object metadata
+            response = s3_client.head_object(Bucket=bucket_name, Key=s3_file_name)
 
         # Log a success message
         logging.info(f'Uploaded {local_file_path} to {bucket_name}/{s3_file_name}')
 
-        # Extract the ETag (MD5 checksum) from the response
+        # Extract the ETag from the response
         s3_md5 = response['ETag'].strip('"')
 
-        return True, s3_md5
+        return True, s3_md5, None
 
     except Exception as e:
-        # Log an error if the upload fails
+        # Log an error if the upload fails, the caller decides whether to retry and notify
         logging.error(f'Error uploading {local_file_path} to S3: {e}')
 
-        # Prepare and send an email notification
-        subject = 'Upload to S3'
-        body = f"Error uploading {local_file_path} to S3: {e}"
-        send_email(subject, body)
-
-        return False, None
+        return False, None, e
 
 
 def delete_object_from_s3(bucket_name, s3_file_name, s3_client):
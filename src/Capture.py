@@ -1,11 +1,275 @@
 import os
+import atexit
+import functools
+import subprocess
+import threading
 from datetime import datetime
 import logging
 from network import send_email
 import ffmpeg
 
+# JPEG start and end of image markers, used to split the MJPEG pipe into frames
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
 
-def capture_image(rtsp_url, image_base_directory, timezone):
+# H.264 encoders in order of preference with their low latency options, the software encoder is the last resort
+H264_ENCODERS = (
+    ('h264_nvenc', {'preset': 'p1', 'tune': 'll'}),  # NVIDIA GPUs
+    ('h264_v4l2m2m', {}),  # Raspberry Pi and other V4L2 M2M hardware encoders
+    ('h264_videotoolbox', {}),  # macOS
+    ('libx264', {'preset': 'veryfast'}),
+)
+
+# Pixel format of transcoded videos, supported by all H.264 decoders
+H264_PIX_FMT = 'yuv420p'
+
+# Delays between reconnection attempts of the image stream, doubled after every failed attempt
+STREAM_INITIAL_BACKOFF = 1.0
+STREAM_MAX_BACKOFF = 60.0
+
+
+class StreamSession:
+    """
+    A long-lived ffmpeg process attached to an RTSP stream, decoding it into JPEG frames.
+
+    Args:
+    rtsp_url (str): The RTSP stream URL.
+    initial_backoff (float, optional): The seconds to wait before the first reconnection attempt (default is 1).
+    max_backoff (float, optional): The maximum seconds to wait between reconnection attempts (default is 60).
+
+    Keeping a single ffmpeg process attached to the stream avoids paying the process start, codec initialization,
+    RTSP handshake and wait for the next key frame on every image capture. A background thread drains the MJPEG
+    pipe and keeps the latest frame, so ffmpeg never blocks on a full pipe and the frame is always recent.
+    When the stream ends (camera reboot, network loss), the thread reconnects with exponential backoff.
+
+    The session is opt-in (`persistent_stream` in the [camera] section of 'config.ini'), since it trades a few
+    seconds saved per image for a constant cost: ffmpeg decodes the stream and encodes a JPEG every second around
+    the clock, which keeps a Raspberry Pi busy and warm, and the camera has to serve a second, concurrent RTSP
+    session while a video is captured, which some IP cameras do not allow.
+
+    Example:
+    >>> session = StreamSession('rtsp://camera/stream')
+    >>> session.start()
+    >>> frame = session.grab_frame(timeout=10)
+    """
+
+    def __init__(self, rtsp_url, initial_backoff=STREAM_INITIAL_BACKOFF, max_backoff=STREAM_MAX_BACKOFF):
+        self.rtsp_url = rtsp_url
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._process = None
+        self._frame = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._frame_ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """
+        Starts the background thread running the ffmpeg process, if it is not running.
+
+        Returns:
+        None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the ffmpeg process and the background thread.
+
+        Returns:
+        None
+        """
+        self._stopped.set()
+        self.restart()
+
+    def restart(self):
+        """
+        Kills the current ffmpeg process, so the background thread reconnects to the stream.
+
+        Returns:
+        None
+
+        Used when the process is alive but stopped producing frames, which would otherwise go unnoticed.
+        """
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+
+    def grab_frame(self, timeout):
+        """
+        Waits for a frame decoded after this call and returns it.
+
+        Args:
+        timeout (float): The number of seconds to wait for a new frame.
+
+        Returns:
+        bytes or None: The JPEG encoded frame, None if no frame was received within the timeout.
+        """
+        self._frame_ready.clear()
+        if not self._frame_ready.wait(timeout):
+            return None
+        with self._lock:
+            return self._frame
+
+    def _run(self):
+        """
+        Runs the ffmpeg process and reconnects with exponential backoff whenever it exits, until stopped.
+        """
+        backoff = self.initial_backoff
+        while not self._stopped.is_set():
+            logging.info("Starting image stream")
+            try:
+                # Only errors are written to the inherited stderr, not the progress statistics of a process
+                # that runs for days
+                process = ffmpeg.input(self.rtsp_url, rtsp_transport='tcp')\
+                    .output('pipe:', format='image2pipe', vcodec='mjpeg', qscale=2, r=1)\
+                    .global_args('-nostats', '-loglevel', 'error')\
+                    .run_async(pipe_stdout=True)
+            except OSError as e:
+                logging.error(f"Error starting image stream: {e}")
+                process = None
+
+            if process is not None:
+                with self._lock:
+                    self._process = process
+                    # stop() may have been called while the process was starting
+                    if self._stopped.is_set():
+                        process.kill()
+
+                # Reset the backoff once the stream delivered frames again
+                if self._read_frames(process):
+                    backoff = self.initial_backoff
+                process.kill()
+                process.wait()
+
+            if self._stopped.wait(0):
+                break
+            logging.warning(f"Image stream ended, reconnecting in {backoff:.0f} seconds")
+            self._stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _read_frames(self, process):
+        """
+        Reads JPEG frames from the stdout of the ffmpeg process and keeps the latest one, until EOF.
+
+        Args:
+        process (subprocess.Popen): The ffmpeg process writing an MJPEG stream to its stdout.
+
+        Returns:
+        bool: True if at least one frame was received.
+        """
+        received = False
+        buffer = bytearray()
+        while True:
+            chunk = process.stdout.read1(65536)
+            if not chunk:
+                return received
+            buffer += chunk
+
+            # Extract every complete frame in the buffer, keeping only the most recent one
+            while True:
+                start = buffer.find(JPEG_SOI)
+                if start == -1:
+                    # Keep a trailing 0xFF, it may be the first byte of a start marker split across two reads
+                    if buffer.endswith(JPEG_SOI[:1]):
+                        del buffer[:-1]
+                    else:
+                        buffer.clear()
+                    break
+                end = buffer.find(JPEG_EOI, start + 2)
+                if end == -1:
+                    del buffer[:start]
+                    break
+                with self._lock:
+                    self._frame = bytes(buffer[start:end + 2])
+                self._frame_ready.set()
+                received = True
+                del buffer[:end + 2]
+
+
+# The stream session shared by all image captures of the process
+_stream_session = None
+_stream_session_lock = threading.Lock()
+
+
+def start_image_stream(rtsp_url):
+    """
+    Starts the shared stream session for the RTSP stream, if it is not running.
+
+    Args:
+    rtsp_url (str): The RTSP stream URL.
+
+    Returns:
+    StreamSession: The running stream session.
+
+    A session attached to a different URL is stopped and replaced.
+    """
+    global _stream_session
+    with _stream_session_lock:
+        if _stream_session is not None and _stream_session.rtsp_url != rtsp_url:
+            _stream_session.stop()
+            _stream_session = None
+        if _stream_session is None:
+            _stream_session = StreamSession(rtsp_url)
+        _stream_session.start()
+        return _stream_session
+
+
+def stop_image_stream():
+    """
+    Stops the shared stream session, if it is running.
+
+    Returns:
+    None
+    """
+    global _stream_session
+    with _stream_session_lock:
+        if _stream_session is not None:
+            _stream_session.stop()
+            _stream_session = None
+
+
+atexit.register(stop_image_stream)
+
+
+@functools.lru_cache(maxsize=1)
+def get_h264_encoder():
+    """
+    Selects the fastest H.264 encoder that works on this machine.
+
+    Returns:
+    tuple:
+        - str: The name of the ffmpeg encoder.
+        - dict: The ffmpeg output options for the encoder.
+
+    Each encoder in `H264_ENCODERS` is probed by encoding a few frames of a test source, since an encoder being
+    compiled into ffmpeg does not mean the hardware is present. The probe uses the same encoder options and pixel
+    format as `capture_video`, so an encoder that rejects them is skipped instead of failing every transcoded capture.
+    The result is cached for the lifetime of the process.
+    """
+    for encoder, options in H264_ENCODERS:
+        # The encoder options as command line arguments, e.g. ['-preset', 'veryfast']
+        option_args = [arg for key, value in options.items() for arg in (f'-{key}', str(value))]
+        try:
+            subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                            '-i', 'testsrc=size=256x256:rate=10:duration=0.5', '-c:v', encoder, *option_args,
+                            '-pix_fmt', H264_PIX_FMT, '-f', 'null', '-'],
+                           check=True, capture_output=True, timeout=30)
+            logging.info(f"Using {encoder} for video encoding")
+            return encoder, options
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            continue
+
+    logging.warning("No working H.264 encoder found, falling back to libx264")
+    return H264_ENCODERS[-1]
+
+
+def capture_image(rtsp_url, image_base_directory, timezone, timeout=10, persistent_stream=False):
     """
     Captures an image from the RTSP stream and saves it to the specified directory.
 
@@ -13,12 +277,21 @@ def capture_image(rtsp_url, image_base_directory, timezone):
     rtsp_url (str): The RTSP stream URL.
     image_base_directory (str): The base directory where the captured images will be saved.
     timezone (datetime.tzinfo): The timezone information to timestamp the image filename correctly.
+    timeout (int, optional): The number of seconds to wait for a new frame of the persistent stream
+                             (default is 10 seconds).
+    persistent_stream (bool, optional): Whether to take the frame from the shared stream session instead of
+                                        running ffmpeg for this capture (default is False).
 
     Returns:
     tuple:
         - image_path (str): The full path of the saved image.
         - image_filename (str): The name of the saved image file.
 
+    By default a single frame is captured by an ffmpeg process started for this capture, which connects to the
+    camera and exits once the image is saved. With `persistent_stream`, the frame is taken from the shared stream
+    session (see `StreamSession` for the trade-off) and written to disk as is, without re-encoding.
+    The session is started if it is not running.
+
     If an image capture fails, the function returns (None, None).
     If an exception occurs during capture or saving, an email notification is sent, and (None, None) is returned.
     """
@@ -30,17 +303,34 @@ def capture_image(rtsp_url, image_base_directory, timezone):
         image_filename = f"image_capture_{datetime.now(timezone).strftime('%Y-%m-%d_%H-%M-%S')}.jpg"
         image_path = os.path.join(image_base_directory, image_filename)
 
-        # Capture a single frame from the RTSP stream and save it as an image
-        ffmpeg.input(rtsp_url, rtsp_transport='tcp')\
-        .output(image_path, vframes=1, qscale=2)\
-        .run()
+        if persistent_stream:
+            # Wait for a frame decoded after this call, so the image is not stale
+            session = start_image_stream(rtsp_url)
+            frame = session.grab_frame(timeout)
+            if frame is None:
+                # Reconnect to the stream, it is not producing frames
+                session.restart()
+                raise TimeoutError(f"No frame received from the image stream within {timeout} seconds")
+
+            # Save the JPEG frame as the image
+            with open(image_path, 'wb') as f:
+                f.write(frame)
+        else:
+            # Capture a single frame from the RTSP stream and save it as an image. The output of ffmpeg is
+            # captured instead of written to the inherited stderr, and reported if the capture fails.
+            ffmpeg.input(rtsp_url, rtsp_transport='tcp')\
+            .output(image_path, vframes=1, qscale=2)\
+            .global_args('-nostats', '-loglevel', 'error')\
+            .run(capture_stdout=True, capture_stderr=True)
 
         # Return the path and filename of the saved image
         return image_path, image_filename
 
     except ffmpeg.Error as e:
-        logging.error(f"Error capturing image: {e}")
-        send_email('Error capturing image', f"Error capturing image: {e}")
+        # Include the captured error output of ffmpeg, if any
+        details = e.stderr.decode(errors='replace').strip() if e.stderr else e
+        logging.error(f"Error capturing image: {details}")
+        send_email('Error capturing image', f"Error capturing image: {details}")
         return None, None
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
@@ -48,7 +338,7 @@ def capture_image(rtsp_url, image_base_directory, timezone):
         return None, None
 
 
-def capture_video(rtsp_url, video_base_directory, timezone, duration=40):
+def capture_video(rtsp_url, video_base_directory, timezone, duration=40, transcode=False, resize=None):
     """
     Captures a video from the RTSP stream and saves it to the specified directory.
 
@@ -57,12 +347,19 @@ def capture_video(rtsp_url, video_base_directory, timezone, duration=40):
     video_base_directory (str): The base directory where the captured video will be saved.
     timezone (datetime.tzinfo): The timezone information to timestamp the video filename correctly.
     duration (int, optional): The duration of the video in seconds (default is 40 seconds).
+    transcode (bool, optional): Whether to re-encode the stream to H.264 instead of copying it (default is False).
+    resize (str, optional): The output size as "WIDTHxHEIGHT" (e.g. "1280x720"). Resizing requires re-encoding,
+                            so it implies `transcode` (default is None, keeping the camera resolution).
 
     Returns:
     tuple:
         - video_path (str): The full path of the saved video.
         - video_filename (str): The name of the saved video file.
 
+    By default the camera stream is copied into the file without decoding or encoding. If the camera does not
+    deliver a stream that can be stored as is, `transcode` re-encodes it with the encoder from `get_h264_encoder`,
+    which uses a hardware encoder when available. Resizing is done by ffmpeg in the same pass as the encoding.
+
     If a video capture fails or an error occurs, the function returns (None, None).
     If an exception occurs, an email notification is sent, and (None, None) is returned.
     """
@@ -76,8 +373,16 @@ def capture_video(rtsp_url, video_base_directory, timezone, duration=40):
 
         # Capture video from the RTSP stream for the specified duration
         logging.info(f"Capturing video at {video_path}")
+        if transcode or resize:
+            encoder, options = get_h264_encoder()
+            output_options = dict(vcodec=encoder, pix_fmt=H264_PIX_FMT, **options)
+            if resize:
+                width, height = resize.lower().split('x')
+                output_options['vf'] = f'scale={width}:{height}'
+        else:
+            output_options = dict(vcodec='copy')
         ffmpeg.input(rtsp_url, rtsp_transport='tcp')\
-        .output(video_path, vcodec='copy', t=40)\
+        .output(video_path, t=duration, **output_options)\
         .run()
         logging.info(f"Finished Capturing video at {video_path}")
 
@@ -1,6 +1,26 @@
 import logging
-import base64
-from network import send_email
+from google.api_core.exceptions import Forbidden, NotFound, Unauthorized
+from google.auth.exceptions import DefaultCredentialsError, RefreshError
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+# Chunk size for resumable uploads of files too large for a single request (must be a multiple of 256 KiB)
+GCS_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Retry transient errors (429, 5xx, connection errors) with exponential backoff
+GCS_RETRY = DEFAULT_RETRY.with_delay(initial=1.0, maximum=60.0, multiplier=2.0)
+
+
+def is_fatal_gcs_error(error):
+    """
+    Checks whether a GCS upload error is permanent, so that retrying the upload is pointless.
+
+    Args:
+    error (Exception): The exception raised by the upload.
+
+    Returns:
+    bool: True for invalid credentials, denied access or a missing bucket, False otherwise.
+    """
+    return isinstance(error, (Forbidden, NotFound, Unauthorized, DefaultCredentialsError, RefreshError))
 
 
 def upload_to_gcs(local_file_path, bucket_name, gcs_blob_name, gcs_client):
@@ -15,51 +35,41 @@ def upload_to_gcs(local_file_path, bucket_name, gcs_blob_name, gcs_client):
 
     Returns:
     tuple: A tuple containing:
-        - bool: True if the upload is successful, False otherwise.
-        - str or None: The MD5 checksum of the uploaded file in hexadecimal format if successful, None otherwise.
+        - bool: True if the upload is successful and verified, False otherwise.
+        - Exception or None: The error that made the upload fail, None if successful.
 
-    This function uploads a file to a specified GCS bucket, logs the result of the operation, and retrieves the MD5 hash of the uploaded file.
-    The MD5 checksum is used for verifying the upload.
+    This function uploads a file to a specified GCS bucket and logs the result of the operation.
+    Large files are sent as a resumable upload in chunks of `GCS_CHUNK_SIZE`.
+    The upload is verified by the client library: it calculates the MD5 checksum of the sent data and compares it
+    with the MD5 hash reported by GCS. On a mismatch the library deletes the uploaded object and raises
+    `DataCorruption`, so a successful upload is also a verified one.
+    Transient errors are retried with exponential backoff (`GCS_RETRY`), other errors fail immediately.
 
     Example:
     >>> upload_to_gcs('/path/to/file.txt', 'my-bucket', 'path/in/bucket/file.txt', gcs_client)
-    (True, 'd41d8cd98f00b204e9800998ecf8427e')
+    (True, None)
     """
     try:
         # Retrieve the GCS bucket object
         bucket = gcs_client.bucket(bucket_name)
 
         # Create a blob (object) from the specified blob name
-        blob = bucket.blob(gcs_blob_name)
+        blob = bucket.blob(gcs_blob_name, chunk_size=GCS_CHUNK_SIZE)
 
-        # Upload the local file to GCS
-        blob.upload_from_filename(local_file_path)
+        # Upload the local file to GCS. With checksum='md5' the MD5 of the sent data is compared to the one
+        # reported by GCS, a mismatch deletes the object, raises DataCorruption and fails the upload.
+        blob.upload_from_filename(local_file_path, checksum='md5', retry=GCS_RETRY)
 
         # Log a success message
         logging.info(f'Uploaded {local_file_path} to {bucket_name}/{gcs_blob_name}')
 
-        # Reload the blob to fetch updated metadata
-        blob.reload()
-
-        # Retrieve the MD5 hash of the uploaded file
-        gcs_md5 = blob.md5_hash
-
-        # Decode the base64-encoded MD5 hash and convert to hexadecimal
-        gcs_md5_bytes = base64.b64decode(gcs_md5)
-        gcs_md5_hex = gcs_md5_bytes.hex()
-
-        return True, gcs_md5_hex
+        return True, None
 
     except Exception as e:
-        # Log an error if the upload fails
+        # Log an error if the upload fails, the caller decides whether to notify
         logging.error(f'Error uploading {local_file_path} to GCS: {e}')
 
-        # Prepare and send an email notification with the error details
-        subject = 'Upload to GCS'
-        body = f"Error uploading {local_file_path} to GCS: {e}"
-        send_email(subject, body)
-
-        return False, None
+        return False, e
 
 
 def delete_object_from_gcs(bucket_name, file_name, gcs_client):
@@ -1,10 +1,45 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from databasewrite import execute_db_operation
 
+# SQL statement marking a file as deleted from local storage
+_SQL_MARK_DELETED = '''
+    UPDATE filestatus
+    SET localstatus = 0,
+        localdestination = NULL
+    WHERE filename = ?
+'''
 
-def delete_old_files(cursor, timezone, days_old=30, aws_upload=True, gcp_upload=True):
+
+def _delete_local_file(localdestination):
+    """
+    Deletes a file from local storage.
+
+    Args:
+    localdestination (str): The local path of the file to delete.
+
+    Returns:
+    bool: True if the file was deleted or did not exist, False if it could not be deleted.
+
+    The file is removed without checking for it first, a missing file is handled by catching FileNotFoundError.
+    This saves a stat call per file and cannot race with another process removing the file.
+    """
+    try:
+        # Remove the local file
+        os.remove(localdestination)
+        logging.info(f"Deleted local file: {localdestination}")
+        return True
+    except FileNotFoundError:
+        logging.warning(f"Local file does not exist: {localdestination}")
+        return True
+    except OSError as e:
+        logging.error(f"Error deleting file {localdestination}: {e}")
+        return False
+
+
+def delete_old_files(cursor, timezone, days_old=30, aws_upload=True, gcp_upload=True, max_workers=4):
     """
     Deletes old files from local storage based on their upload status and last modification date.
 
@@ -14,13 +49,15 @@ def delete_old_files(cursor, timezone, days_old=30, aws_upload=True, gcp_upload=
     days_old (int, optional): The number of days old files must be to be deleted (default is 30).
     aws_upload (bool, optional): Whether to include files uploaded to AWS S3 in the deletion criteria (default is True).
     gcp_upload (bool, optional): Whether to include files uploaded to GCS in the deletion criteria (default is True).
+    max_workers (int, optional): The number of files deleted in parallel (default is 4).
 
     Returns:
     None
 
     This function calculates the cutoff date for file deletion, queries the database to find files that are
-    older than the cutoff date and meet the upload status criteria, deletes these files from local storage,
-    and updates the database record to reflect the deletion.
+    older than the cutoff date and meet the upload status criteria, deletes these files from local storage
+    using a small thread pool, and updates the database records of the deleted files in a single batch.
+    Files that could not be deleted keep their record, so they are retried on the next cleanup.
 
     Example:
     >>> delete_old_files(cursor, pytz.utc, days_old=30, aws_upload=True, gcp_upload=True
@@ -54,24 +91,14 @@ def delete_old_files(cursor, timezone, days_old=30, aws_upload=True, gcp_upload=
 
     logging.info(f"Deleting {len(files_to_delete)} files from local storage")
 
-    for filename, localdestination in files_to_delete:
-        try:
-            # Remove the local file
-            if os.path.exists(localdestination):
-                os.remove(localdestination)
-                logging.info(f"Deleted local file: {localdestination}")
-            else:
-                logging.warning(f"Local file does not exist: {localdestination}")
-        except OSError as e:
-            logging.error(f"Error deleting file {localdestination}: {e}")
-
-        # Update the database record
-        def update_db_record(cursor, filename):
-            cursor.execute('''
-                UPDATE filestatus
-                SET localstatus = 0,
-                    localdestination = NULL
-                WHERE filename = ?
-            ''', (filename,))
-
-        execute_db_operation(update_db_record, cursor, filename)
+    # Delete the files in parallel, the unlink calls release the GIL
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_delete_local_file, [row['localdestination'] for row in files_to_delete])
+        deleted_files = [row['filename'] for row, deleted in zip(files_to_delete, results) if deleted]
+
+    # Update the database records of all deleted files in one statement and one commit
+    def update_db_records(cursor, filenames):
+        cursor.executemany(_SQL_MARK_DELETED, [(filename,) for filename in filenames])
+
+    if deleted_files:
+        execute_db_operation(update_db_records, cursor, deleted_files)
@@ -1,10 +1,125 @@
 import logging
-from utils import extract_datetime_from_filename, data_integrity_check
-from AWSbucketmanager import upload_to_s3, delete_object_from_s3
-from GCSbucketmanager import upload_to_gcs, delete_object_from_gcs
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import extract_datetime_from_filename, data_integrity_check, calculate_md5, calculate_multipart_etag
+from AWSbucketmanager import (upload_to_s3, delete_object_from_s3, get_multipart_chunksize, get_s3_key,
+                              is_fatal_s3_error, MULTIPART_THRESHOLD)
+from GCSbucketmanager import upload_to_gcs, is_fatal_gcs_error
 from network import send_email
-from databasewrite import execute_db_operation, update_file_record_aws, update_file_record_gcp
-from databaseread import get_unuploaded_files, is_uploaded_to_aws, is_uploaded_to_gcp
+from databasewrite import execute_db_operation, update_file_records_aws, update_file_records_gcp
+from databaseread import get_unuploaded_files
+
+# Number of uploads of a file whose integrity check fails, transient errors are retried by the cloud clients
+MAX_UPLOAD_ATTEMPTS = 2
+
+
+def _calculate_s3_etag(file_path):
+    """
+    Calculates the ETag that S3 is expected to report for a file once it is uploaded.
+
+    Args:
+    file_path (str): The local path of the file to be uploaded.
+
+    Returns:
+    str: The MD5 checksum of the file for single part uploads, or the multipart ETag for files of at least
+         `MULTIPART_THRESHOLD` bytes, which `upload_to_s3` uploads in parts.
+
+    Only one of the two checksums is calculated, so each file is read and hashed once before it is uploaded.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size >= MULTIPART_THRESHOLD:
+        # Large files are uploaded in parts, their ETag is derived from the part checksums instead of the file MD5
+        return calculate_multipart_etag(file_path, get_multipart_chunksize(file_size))
+    return calculate_md5(file_path)
+
+
+def _upload_to_aws_with_retries(file_path, file_name, aws_path, bucket_name_aws, s3_client, local_etag):
+    """
+    Uploads a file to AWS S3 and verifies its integrity, uploading it again if the integrity check fails.
+
+    Args:
+    file_path (str): The local path of the file to be uploaded.
+    file_name (str): The name of the file to be used in the cloud storage.
+    aws_path (str): The key of the file in the S3 bucket (e.g. "ac/2024/August/<file_name>").
+    bucket_name_aws (str): The name of the AWS S3 bucket.
+    s3_client (boto3.client): An initialized AWS S3 client object.
+    local_etag (str): The expected ETag of the local file, calculated once by `_calculate_s3_etag`.
+
+    Returns:
+    tuple: A tuple containing:
+        - bool: True if the file was successfully uploaded to AWS S3, False otherwise.
+        - bool: True if the file integrity was confirmed for AWS S3.
+        - bool: True if the upload failed with a permanent error (e.g. access denied or missing bucket).
+
+    Transient errors (throttling, 5xx, connection errors) are retried with backoff by the S3 client itself,
+    so a failed upload is not retried here. Only an upload whose checksum does not match is deleted and
+    uploaded again, up to `MAX_UPLOAD_ATTEMPTS` times. A single email notification is sent per failed file.
+    """
+    aws_uploaded = dataintegrityAWS = False
+    error = None
+
+    for attempt in range(1, MAX_UPLOAD_ATTEMPTS + 1):
+        aws_uploaded, s3_md5, error = upload_to_s3(file_path, bucket_name_aws, aws_path, s3_client)
+        if not aws_uploaded:
+            break
+
+        dataintegrityAWS = data_integrity_check(local_etag, s3_md5)
+        if dataintegrityAWS:
+            logging.info(f'Successfully uploaded {file_name} to AWS on attempt {attempt} with fidelity')
+            break
+
+        # Remove the corrupted object before uploading the file again
+        delete_object_from_s3(bucket_name_aws, aws_path, s3_client)
+        aws_uploaded = False
+        logging.info(f'Data integrity check failed for AWS, retrying {file_name} (attempt {attempt})')
+
+    if not aws_uploaded:
+        logging.error(f'Failed to upload {file_name} to AWS.')
+        if error is not None:
+            subject = 'Upload to S3'
+            body = f"Error uploading {file_path} to S3: {error}"
+        else:
+            subject = 'AWS Data Integrity Issue'
+            body = f'Failed to ensure data integrity for {file_name} after {attempt} attempts.'
+        send_email(subject, body)
+
+    return aws_uploaded, dataintegrityAWS, error is not None and is_fatal_s3_error(error)
+
+
+def _upload_to_gcp(file_path, file_name, gcs_path, bucket_name_gcp, gcs_client):
+    """
+    Uploads a file to Google Cloud Storage (GCS) and reports the result.
+
+    Args:
+    file_path (str): The local path of the file to be uploaded.
+    file_name (str): The name of the file to be used in the cloud storage.
+    gcs_path (str): The name of the blob in the GCS bucket (e.g. "2024/August/<file_name>").
+    bucket_name_gcp (str): The name of the GCS bucket.
+    gcs_client (google.cloud.storage.Client): An initialized GCS client object.
+
+    Returns:
+    tuple: A tuple containing:
+        - bool: True if the file was successfully uploaded to GCS, False otherwise.
+        - bool: True if the file integrity was confirmed for GCS.
+        - bool: True if the upload failed with a permanent error (e.g. access denied or missing bucket).
+
+    `upload_to_gcs` retries transient errors with exponential backoff and verifies the MD5 checksum of the sent data
+    against the one reported by GCS, deleting the object on a mismatch. A successful upload is therefore also
+    verified, and a failed one is not retried here. A single email notification is sent per failed file.
+    """
+    gcp_uploaded, error = upload_to_gcs(file_path, bucket_name_gcp, gcs_path, gcs_client)
+
+    if gcp_uploaded:
+        logging.info(f'Successfully uploaded {file_name} to GCP with fidelity')
+    else:
+        logging.error(f'Failed to upload {file_name} to GCP.')
+        send_email('Upload to GCS', f"Error uploading {file_path} to GCS: {error}")
+
+    # A successful GCS upload is a verified one
+    return gcp_uploaded, gcp_uploaded, error is not None and is_fatal_gcs_error(error)
+
+
 def upload_files_to_cloud(file_path, file_name, bucket_name_aws, bucket_name_gcp, aws_upload, gcp_upload, s3_client,
                           gcs_client):
     """
@@ -28,8 +143,12 @@ def upload_files_to_cloud(file_path, file_name, bucket_name_aws, bucket_name_gcp
         - bool: True if the file integrity was confirmed for GCS.
 
     This function uploads a file to the specified cloud storage services (AWS S3 and/or GCS), checks the integrity
-    of the uploaded file using MD5 checksums, and retries the upload if necessary. The file path is organized
-    in a folder structure based on the extracted year and month from the file name.
+    of the uploaded file using MD5 checksums, and uploads the file again if the check fails. The expected S3 ETag is
+    calculated once and reused for every attempt, GCS uploads verify the MD5 checksum of the sent data themselves,
+    so the file is only hashed locally when uploading to AWS. When both services are enabled,
+    the AWS and GCS uploads run concurrently in separate threads. The file path is organized in a folder structure
+    based on the extracted year and month from the file name, S3 keys are additionally prefixed with a short hash
+    of the file name (see `get_s3_key`) to spread the requests over several S3 partitions.
 
     Example:
     >>> upload_files_to_cloud('/path/to/file.txt', 'file.txt', 'aws-bucket', 'gcs-bucket', True, True, s3_client, gcs_client)
@@ -39,69 +158,119 @@ def upload_files_to_cloud(file_path, file_name, bucket_name_aws, bucket_name_gcp
     aws_uploaded = gcp_uploaded = False
     dataintegrityAWS = dataintegrityGCP = False
 
-    # Handle AWS S3 upload with retries
+    if not (aws_upload or gcp_upload):
+        return aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP
+
+    # Hash the local file once for the S3 ETag comparison, the checksum is reused for every upload attempt.
+    # GCS verifies the MD5 checksum of the uploaded data itself.
+    local_etag = None
     if aws_upload:
-        attempts = 0
-        _, year, month = extract_datetime_from_filename(file_name)
-        aws_path = f"{year}/{month}/{file_name}"
-
-        while attempts < 5:
-            aws_uploaded, s3_md5 = upload_to_s3(file_path, bucket_name_aws, aws_path, s3_client)
-
-            if aws_uploaded:
-                dataintegrityAWS = data_integrity_check(file_path, s3_md5)
-                if dataintegrityAWS:
-                    logging.info(f'Successfully uploaded {file_name} to AWS on attempt {attempts + 1} with fidelity')
-                    break
-                else:
-                    delete_object_from_s3(bucket_name_aws, aws_path, s3_client)
-                    logging.info(f'Upload failed for AWS, retrying {file_name} (attempt {attempts + 1})')
-            else:
-                logging.info(f'Upload failed for AWS, retrying {file_name} (attempt {attempts + 1})')
+        try:
+            local_etag = _calculate_s3_etag(file_path)
+        except OSError as e:
+            logging.error(f"Error calculating the MD5 checksum of {file_path}: {e}")
+            return aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP
 
-            attempts += 1
+    # Both clouds use the year/month folder structure, S3 keys get an additional hash prefix
+    _, year, month = extract_datetime_from_filename(file_name)
+    aws_path = get_s3_key(file_name, year, month)
+    gcs_path = f"{year}/{month}/{file_name}"
 
-        if not aws_uploaded:
-            logging.error(f'Failed to upload {file_name} to AWS after 5 attempts.')
-            if dataintegrityAWS is False:
-                subject = 'AWS Data Integrity Issue'
-                body = f'Failed to ensure data integrity for {file_name} after 5 attempts.'
-                send_email(subject, body)
-
-    # Handle GCS upload with retries
-    if gcp_upload:
-        attempts = 0
-        _, year, month = extract_datetime_from_filename(file_name)
-        gcs_path = f"{year}/{month}/{file_name}"
-
-        while attempts < 5:
-            gcp_uploaded, gcs_md5 = upload_to_gcs(file_path, bucket_name_gcp, gcs_path, gcs_client)
-
-            if gcp_uploaded:
-                dataintegrityGCP = data_integrity_check(file_path, gcs_md5)
-                if dataintegrityGCP:
-                    logging.info(f'Successfully uploaded {file_name} to GCP on attempt {attempts + 1} with fidelity')
-                    break
+    if aws_upload and gcp_upload:
+        # Both uploads are network bound and independent, so run them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            aws_future = executor.submit(_upload_to_aws_with_retries, file_path, file_name, aws_path,
+                                         bucket_name_aws, s3_client, local_etag)
+            gcp_future = executor.submit(_upload_to_gcp, file_path, file_name, gcs_path, bucket_name_gcp, gcs_client)
+            aws_uploaded, dataintegrityAWS, _ = aws_future.result()
+            gcp_uploaded, dataintegrityGCP, _ = gcp_future.result()
+    elif aws_upload:
+        aws_uploaded, dataintegrityAWS, _ = _upload_to_aws_with_retries(file_path, file_name, aws_path,
+                                                                        bucket_name_aws, s3_client, local_etag)
+    else:
+        gcp_uploaded, dataintegrityGCP, _ = _upload_to_gcp(file_path, file_name, gcs_path, bucket_name_gcp,
+                                                           gcs_client)
+
+    return aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP
+
+
+def _upload_unuploaded_file(filename, filetype, localdestination, upload_aws, upload_gcp, AWS_image_bucket_name,
+                            AWS_video_bucket_name, GCP_image_bucket_name, GCP_video_bucket_name, s3_client, gcs_client,
+                            fatal_errors):
+    """
+    Uploads a single unuploaded file to AWS S3 and/or GCS.
+
+    Args:
+    filename (str): The name of the file.
+    filetype (str): The type of the file ('image' or 'video').
+    localdestination (str): The local path of the file.
+    upload_aws (bool): Whether the file still has to be uploaded to AWS S3.
+    upload_gcp (bool): Whether the file still has to be uploaded to GCS.
+    AWS_image_bucket_name (str): The name of the AWS S3 bucket for images.
+    AWS_video_bucket_name (str): The name of the AWS S3 bucket for videos.
+    GCP_image_bucket_name (str): The name of the GCS bucket for images.
+    GCP_video_bucket_name (str): The name of the GCS bucket for videos.
+    s3_client (boto3.client): An initialized AWS S3 client object.
+    gcs_client (google.cloud.storage.Client): An initialized GCS client object.
+    fatal_errors (dict): A threading.Event per cloud ('aws', 'gcp') that is set once an upload to that cloud
+                         failed with a permanent error, after which the remaining files skip that cloud.
+
+    Returns:
+    tuple: A tuple containing:
+        - tuple or None: The (filename, destination, bucket_name, dataintegrity) record for the AWS upload,
+                         None if the file was not uploaded to AWS.
+        - tuple or None: The (filename, destination, bucket_name, dataintegrity) record for the GCP upload,
+                         None if the file was not uploaded to GCP.
+
+    This function does not touch the database, so it can safely run in a worker thread.
+    """
+    aws_record = gcp_record = None
+
+    try:
+        # Extract year and month from the filename for folder structure
+        _, year, month = extract_datetime_from_filename(filename)
+
+        if year and month and (upload_aws or upload_gcp):
+            # Determine the appropriate AWS bucket and upload the file if required
+            if upload_aws:
+                if fatal_errors['aws'].is_set():
+                    logging.error(f"Skipping AWS upload of {filename} after a permanent AWS error")
                 else:
-                    delete_object_from_gcs(bucket_name_gcp, gcs_path, gcs_client)
-                    logging.info(f'Upload failed for GCP, retrying {file_name} (attempt {attempts + 1})')
-            else:
-                logging.info(f'Upload failed for GCP, retrying {file_name} (attempt {attempts + 1})')
+                    bucket_name_aws = AWS_image_bucket_name if filetype == 'image' else AWS_video_bucket_name
+                    aws_destination = get_s3_key(filename, year, month)
+                    # Only the S3 ETag comparison needs a local checksum, GCS verifies the uploaded data itself
+                    local_etag = _calculate_s3_etag(localdestination)
+                    aws_uploaded, dataintegrityAWS, fatal = _upload_to_aws_with_retries(
+                        localdestination, filename, aws_destination, bucket_name_aws, s3_client, local_etag)
+                    if fatal:
+                        fatal_errors['aws'].set()
+                    if aws_uploaded:
+                        aws_record = (filename, aws_destination, bucket_name_aws, dataintegrityAWS)
 
-            attempts += 1
+            # Determine the appropriate GCS bucket and upload the file if required
+            if upload_gcp:
+                if fatal_errors['gcp'].is_set():
+                    logging.error(f"Skipping GCP upload of {filename} after a permanent GCP error")
+                else:
+                    bucket_name_gcp = GCP_image_bucket_name if filetype == 'image' else GCP_video_bucket_name
+                    gcs_destination = f"{year}/{month}/{filename}"
+                    gcp_uploaded, dataintegrityGCP, fatal = _upload_to_gcp(
+                        localdestination, filename, gcs_destination, bucket_name_gcp, gcs_client)
+                    if fatal:
+                        fatal_errors['gcp'].set()
+                    if gcp_uploaded:
+                        gcp_record = (filename, gcs_destination, bucket_name_gcp, dataintegrityGCP)
 
-        if not gcp_uploaded:
-            logging.error(f'Failed to upload {file_name} to GCP after 5 attempts.')
-            if dataintegrityGCP is False:
-                subject = 'GCS Data Integrity Issue'
-                body = f'Failed to ensure data integrity for {file_name} after 5 attempts.'
-                send_email(subject, body)
+    except Exception as e:
+        # Log any errors encountered during the upload process
+        logging.error(f"An error occurred while uploading {filename}: {e}")
 
-    return aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP
+    return aws_record, gcp_record
 
 
 def upload_unuploaded_files(cursor, AWS_image_bucket_name, AWS_video_bucket_name, GCP_image_bucket_name,
-                            GCP_video_bucket_name, s3_client, gcs_client, aws_upload=True, gcp_upload=True):
+                            GCP_video_bucket_name, s3_client, gcs_client, aws_upload=True, gcp_upload=True,
+                            max_workers=8):
     """
     Uploads unuploaded files from local storage to AWS S3 and/or Google Cloud Storage (GCS), and updates the database.
 
@@ -115,14 +284,19 @@ def upload_unuploaded_files(cursor, AWS_image_bucket_name, AWS_video_bucket_name
     gcs_client (google.cloud.storage.Client): An initialized GCS client object.
     aws_upload (bool): Flag to indicate whether to upload files to AWS S3. Defaults to True.
     gcp_upload (bool): Flag to indicate whether to upload files to GCS. Defaults to True.
+    max_workers (int, optional): The number of files uploaded in parallel. Defaults to 8.
 
     Returns:
     None
 
     This function:
     1. Retrieves unuploaded files from the database.
-    2. Uploads these files to AWS S3 and/or GCS based on the provided flags.
-    3. Updates the database with the upload status and data integrity information.
+    2. Uploads these files to AWS S3 and/or GCS based on the provided flags, several files at a time.
+    3. Updates the database with the upload status and data integrity information in a single batch.
+
+    The uploads run in a thread pool, while all database reads and writes stay on the calling thread,
+    since the SQLite connection must not be shared between threads. The first file is uploaded before the others,
+    so that a permanent error (e.g. bad credentials) makes the remaining files skip that cloud with a single alert.
 
     Example:
     >>> upload_unuploaded_files(cursor, 'aws-images', 'aws-videos', 'gcp-images', 'gcp-videos', s3_client, gcs_client)
@@ -132,62 +306,35 @@ def upload_unuploaded_files(cursor, AWS_image_bucket_name, AWS_video_bucket_name
     unuploaded_files = get_unuploaded_files(cursor, aws_upload=aws_upload, gcp_upload=gcp_upload)
     logging.info(f"Detected {len(unuploaded_files)} unuploaded files in local storage")
 
-    for filename, filetype, localdestination in unuploaded_files:
-        try:
-            # Extract year and month from the filename for folder structure
-            _, year, month = extract_datetime_from_filename(filename)
+    # Once a cloud fails with a permanent error (e.g. bad credentials), the remaining files skip it
+    fatal_errors = {'aws': threading.Event(), 'gcp': threading.Event()}
 
-            if year and month:
-                # Determine the appropriate AWS bucket and upload the file if required
-                if aws_upload and not is_uploaded_to_aws(cursor, filename):
-                    bucket_name_aws = AWS_image_bucket_name if filetype == 'image' else AWS_video_bucket_name
-                    aws_destination = f"{year}/{month}/{filename}"
-                    aws_uploaded, dataintegrityAWS, _, _ = upload_files_to_cloud(
-                        file_path=localdestination,
-                        file_name=aws_destination,
-                        bucket_name_aws=bucket_name_aws,
-                        bucket_name_gcp=None,
-                        aws_upload=True,
-                        gcp_upload=False,
-                        s3_client=s3_client,
-                        gcs_client=None
-                    )
-                    # Update the database with the AWS upload status
-                    if aws_uploaded:
-                        execute_db_operation(
-                            update_file_record_aws,
-                            cursor,
-                            filename,
-                            aws_destination,
-                            bucket_name_aws,
-                            dataintegrityAWS
-                        )
-
-                # Determine the appropriate GCS bucket and upload the file if required
-                if gcp_upload and not is_uploaded_to_gcp(cursor, filename):
-                    bucket_name_gcp = GCP_image_bucket_name if filetype == 'image' else GCP_video_bucket_name
-                    gcs_destination = f"{year}/{month}/{filename}"
-                    _, _, gcp_uploaded, dataintegrityGCP = upload_files_to_cloud(
-                        file_path=localdestination,
-                        file_name=gcs_destination,
-                        bucket_name_aws=None,
-                        bucket_name_gcp=bucket_name_gcp,
-                        aws_upload=False,
-                        gcp_upload=True,
-                        s3_client=None,
-                        gcs_client=gcs_client
-                    )
-                    # Update the database with the GCP upload status
-                    if gcp_uploaded:
-                        execute_db_operation(
-                            update_file_record_gcp,
-                            cursor,
-                            filename,
-                            gcs_destination,
-                            bucket_name_gcp,
-                            dataintegrityGCP
-                        )
-
-        except Exception as e:
-            # Log any errors encountered during the upload process
-            logging.error(f"An error occurred while uploading {filename}: {e}")
\ No newline at end of file
+    def upload_row(row):
+        # The upload status comes with the query, so no per-file lookups are needed
+        upload_aws = aws_upload and row['AWSstatus'] != 1
+        upload_gcp = gcp_upload and row['GCPstatus'] != 1
+        return _upload_unuploaded_file(
+            row['filename'], row['filetype'], row['localdestination'], upload_aws, upload_gcp,
+            AWS_image_bucket_name, AWS_video_bucket_name, GCP_image_bucket_name, GCP_video_bucket_name,
+            s3_client, gcs_client, fatal_errors)
+
+    results = []
+    if unuploaded_files:
+        # Upload the first file on its own, so that a permanent error is detected before the other files
+        # start uploading, instead of every file of the first batch calling the cloud and sending its own alert
+        results.append(upload_row(unuploaded_files[0]))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(upload_row, row) for row in unuploaded_files[1:]]
+
+            # Collect the upload status as the uploads complete
+            results.extend(future.result() for future in as_completed(futures))
+
+    aws_records = [aws_record for aws_record, _ in results if aws_record]
+    gcp_records = [gcp_record for _, gcp_record in results if gcp_record]
+
+    # Update the database with the upload status, committing each batch once
+    if aws_records:
+        execute_db_operation(update_file_records_aws, cursor, aws_records)
+    if gcp_records:
+        execute_db_operation(update_file_records_gcp, cursor, gcp_records)
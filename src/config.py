@@ -0,0 +1,64 @@
+import configparser
+from types import SimpleNamespace
+
+# The configuration file, relative to the working directory set by start_script.sh
+CONFIG_FILE = 'config.ini'
+
+
+def _load(config_file=CONFIG_FILE):
+    """
+    Reads the configuration file into a namespace.
+
+    Args:
+    config_file (str, optional): The path of the configuration file (default is `CONFIG_FILE`).
+
+    Returns:
+    types.SimpleNamespace: The configuration values as attributes, e.g. `CFG.aws_upload` or `CFG.db_path`.
+
+    The file is parsed once when this module is first imported and shared by every module through `CFG`,
+    instead of each module reading and parsing 'config.ini' on its own. Missing values are None (or False for
+    the flags), so importing the module does not fail when a section is not needed, e.g. [gcp] with gcp = False.
+
+    Example:
+    >>> from config import CFG
+    >>> CFG.aws_upload
+    True
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    return SimpleNamespace(
+        # Cloud platforms to upload to
+        aws_upload=config.getboolean('platform', 'aws', fallback=False),
+        gcp_upload=config.getboolean('platform', 'gcp', fallback=False),
+
+        # Google Cloud Storage
+        gcp_image_bucket_name=config.get('gcp', 'image_bucket_name', fallback=None),
+        gcp_video_bucket_name=config.get('gcp', 'video_bucket_name', fallback=None),
+        gcp_service_account_json=config.get('gcp', 'service_account_json', fallback=None),
+
+        # AWS S3 and SES
+        aws_access_key_id=config.get('aws', 'aws_access_key_id', fallback=None),
+        aws_secret_access_key=config.get('aws', 'aws_secret_access_key', fallback=None),
+        aws_image_bucket_name=config.get('aws', 'image_bucket_name', fallback=None),
+        aws_video_bucket_name=config.get('aws', 'video_bucket_name', fallback=None),
+
+        # Local storage
+        image_base_directory=config.get('directories', 'image_base_directory', fallback=None),
+        video_base_directory=config.get('directories', 'video_base_directory', fallback=None),
+        db_path=config.get('database', 'db_path', fallback=None),
+
+        # Camera
+        camera_address=config.get('camera', 'address', fallback=None),
+        camera_transcode=config.getboolean('camera', 'transcode', fallback=False),
+        camera_resize=config.get('camera', 'resize', fallback=None) or None,
+        camera_persistent_stream=config.getboolean('camera', 'persistent_stream', fallback=False),
+
+        # Email notifications
+        email_source=config.get('email', 'source', fallback=None),
+        email_receiver=config.get('email', 'receiver', fallback=None),
+    )
+
+
+# The configuration shared by all modules
+CFG = _load()
@@ -1,5 +1,29 @@
 import logging
 
+# SQL statements of the unuploaded files, one per (aws_upload, gcp_upload) combination built once at import.
+# Each condition implies the "AWSstatus = 0 OR GCPstatus = 0" predicate of the idx_unuploaded partial index,
+# so SQLite only scans the unuploaded rows instead of the whole table.
+_SQL_SELECT_UNUPLOADED = {
+    (aws_upload, gcp_upload): f'''
+    SELECT filename, filetype, localdestination, AWSstatus, GCPstatus
+    FROM filestatus
+    WHERE {condition}
+      AND localstatus = 1
+'''
+    for (aws_upload, gcp_upload), condition in {
+        (True, True): '(AWSstatus = 0 OR GCPstatus = 0)',
+        (True, False): 'AWSstatus = 0',
+        (False, True): 'GCPstatus = 0',
+    }.items()
+}
+
+# SQL statement of the per-file status lookup
+_SQL_SELECT_UPLOAD_STATUS = '''
+    SELECT AWSstatus, GCPstatus
+    FROM filestatus
+    WHERE filename = ?
+'''
+
 
 def get_unuploaded_files(cursor, aws_upload=True, gcp_upload=True):
     """
@@ -11,42 +35,28 @@ def get_unuploaded_files(cursor, aws_upload=True, gcp_upload=True):
     gcp_upload (bool): Whether to check for files not uploaded to GCP (default is True).
 
     Returns:
-    list: A list of tuples, each containing the filename, filetype, and localdestination of unuploaded files.
+    list: A list of rows, each containing the filename, filetype, localdestination, AWSstatus and GCPstatus
+          of unuploaded files. With the connection from `initialize_database` the rows are `sqlite3.Row`
+          objects, so the columns can be accessed by name.
 
-    This function builds and executes a SQL query to fetch files from the database that have not been uploaded
-    to the specified cloud platforms. The conditions for fetching are based on the `aws_upload` and `gcp_upload`
-    flags. If neither flag is set to True, it returns an empty list.
+    This function executes a SQL query to fetch files from the database that have not been uploaded
+    to the specified cloud platforms. The statement for each combination of the `aws_upload` and `gcp_upload`
+    flags is prepared once at import, so no SQL is built per call. If neither flag is set to True,
+    it returns an empty list. Only files still present in local storage
+    are returned. The upload status columns are included so that callers do not need to query them per file.
 
     Example:
     >>> get_unuploaded_files(cursor, aws_upload=True, gcp_upload=False)
-    [('file1.jpg', 'image', '/local/path/file1.jpg'), ('file2.mp4', 'video', '/local/path/file2.mp4')]
+    [('file1.jpg', 'image', '/local/path/file1.jpg', 0, 1), ('file2.mp4', 'video', '/local/path/file2.mp4', 0, 0)]
     """
     try:
-        # Base SQL query
-        query = '''
-            SELECT filename, filetype, localdestination
-            FROM filestatus
-            WHERE 
-        '''
-
-        # List to hold conditions for the WHERE clause
-        conditions = []
-
-        # Append conditions based on whether AWS or GCP upload checks are enabled
-        if aws_upload:
-            conditions.append("AWSstatus = 0")
-        if gcp_upload:
-            conditions.append("GCPstatus = 0")
-
-        # If there are conditions, join them with OR to fetch files not uploaded to either AWS or GCP
-        if conditions:
-            query += ' OR '.join(conditions)
-        else:
+        query = _SQL_SELECT_UNUPLOADED.get((bool(aws_upload), bool(gcp_upload)))
+        if query is None:
             # No cloud platforms selected for checking
             logging.info("No cloud platform selected for checking unuploaded files.")
             return []
 
-        # Execute the query
+        # Execute the query of the enabled cloud platforms
         cursor.execute(query)
 
         # Fetch all unuploaded files
@@ -61,40 +71,58 @@ def get_unuploaded_files(cursor, aws_upload=True, gcp_upload=True):
         return []
 
 
-def is_uploaded_to_aws(cursor, filename):
+def get_upload_status(cursor, filename):
     """
-    Checks if a file has been uploaded to AWS by querying the database.
+    Checks if a file has been uploaded to AWS and to GCP with a single query.
 
     Args:
     cursor (sqlite3.Cursor): The database cursor used to execute queries.
     filename (str): The name of the file to check.
 
     Returns:
-    bool: True if the file is uploaded to AWS (AWSstatus = 1), False otherwise.
+    tuple: A tuple containing:
+        - bool: True if the file is uploaded to AWS (AWSstatus = 1), False otherwise.
+        - bool: True if the file is uploaded to GCP (GCPstatus = 1), False otherwise.
 
-    This function queries the database to determine if the file has been uploaded to AWS S3 by checking
-    the `AWSstatus` field in the `filestatus` table. It logs a warning if no record is found and an error if
-    an exception occurs.
+    This function reads the `AWSstatus` and `GCPstatus` fields of the file in the `filestatus` table in one
+    lookup. It logs a warning if no record is found and an error if an exception occurs, returning (False, False)
+    in both cases.
 
     Example:
-    >>> is_uploaded_to_aws(cursor, 'example_file.txt')
-    True
+    >>> get_upload_status(cursor, 'example_file.txt')
+    (True, False)
     """
     try:
-        cursor.execute('''
-            SELECT AWSstatus
-            FROM filestatus
-            WHERE filename = ?
-        ''', (filename,))
+        cursor.execute(_SQL_SELECT_UPLOAD_STATUS, (filename,))
         result = cursor.fetchone()
         if result:
-            return result[0] == 1
+            return result['AWSstatus'] == 1, result['GCPstatus'] == 1
         else:
             logging.warning(f"No record found for filename: {filename}")
-            return False
+            return False, False
     except Exception as e:
-        logging.error(f"An error occurred while checking if the file is uploaded to AWS: {e}")
-        return False
+        logging.error(f"An error occurred while checking the upload status of the file: {e}")
+        return False, False
+
+
+def is_uploaded_to_aws(cursor, filename):
+    """
+    Checks if a file has been uploaded to AWS by querying the database.
+
+    Args:
+    cursor (sqlite3.Cursor): The database cursor used to execute queries.
+    filename (str): The name of the file to check.
+
+    Returns:
+    bool: True if the file is uploaded to AWS (AWSstatus = 1), False otherwise.
+
+    Deprecated, use `get_upload_status` when both statuses are needed.
+
+    Example:
+    >>> is_uploaded_to_aws(cursor, 'example_file.txt')
+    True
+    """
+    return get_upload_status(cursor, filename)[0]
 
 
 def is_uploaded_to_gcp(cursor, filename):
@@ -108,26 +136,10 @@ def is_uploaded_to_gcp(cursor, filename):
     Returns:
     bool: True if the file is uploaded to GCP (GCPstatus = 1), False otherwise.
 
-    This function queries the database to determine if the file has been uploaded to GCP by checking
-    the `GCPstatus` field in the `filestatus` table. It logs a warning if no record is found and an error if
-    an exception occurs.
+    Deprecated, use `get_upload_status` when both statuses are needed.
 
     Example:
     >>> is_uploaded_to_gcp(cursor, 'example_file.txt')
     True
     """
-    try:
-        cursor.execute('''
-            SELECT GCPstatus
-            FROM filestatus
-            WHERE filename = ?
-        ''', (filename,))
-        result = cursor.fetchone()
-        if result:
-            return result[0] == 1
-        else:
-            logging.warning(f"No record found for filename: {filename}")
-            return False
-    except Exception as e:
-        logging.error(f"An error occurred while checking if the file is uploaded to GCP: {e}")
-        return False
+    return get_upload_status(cursor, filename)[1]
@@ -1,9 +1,24 @@
 import sqlite3
 import logging
-import time
 from network import send_email
 from utils import extract_datetime_from_filename
 
+# SQL statements shared by the single and batch operations, so that they hit the same statement cache entry
+_SQL_INSERT_FILE = '''
+    INSERT INTO filestatus (filename, filetype, localstatus, localdestination, datetime)
+    VALUES (?, ?, 1, ?, ?)
+'''
+_SQL_UPDATE_AWS = '''
+    UPDATE filestatus
+    SET AWSstatus = 1, AWSdestination = ?, AWSbucketname = ?, dataintegrityAWS = ?
+    WHERE filename = ?
+'''
+_SQL_UPDATE_GCP = '''
+    UPDATE filestatus
+    SET GCPstatus = 1, GCPdestination = ?, GCPbucketname = ?, dataintegrityGCP = ?
+    WHERE filename = ?
+'''
+
 
 def initialize_database(db_path):
     """
@@ -12,17 +27,37 @@ def initialize_database(db_path):
     Args:
     db_path (str): The file path of the SQLite database to connect to or create.
 
+    Returns:
+    sqlite3.Connection: The open connection to the database, to be kept for the lifetime of the process.
+
     The function does the following:
     - Enables Write-Ahead Logging (WAL) mode for better concurrency and performance.
-    - Creates a table named 'filestatus' if it doesn't already exist.
+    - Configures the connection: NORMAL synchronous mode (safe with WAL), a 5 second busy timeout,
+      temporary tables in memory, a 64 MiB page cache and reads through memory mapped I/O of up to 256 MiB.
+    - Creates a table named 'filestatus' if it doesn't already exist. The UNIQUE constraint on `filename`
+      comes with an index, which serves every lookup and update by filename.
     - Defines columns for tracking file statuses across different storage services (GCP, AWS, NAS, etc.),
       their destinations, data integrity, and local file information.
-    """
-    # Connect to the SQLite database at the provided path
-    with sqlite3.connect(db_path) as conn:
-        # Enable Write-Ahead Logging (WAL) mode to improve performance and allow concurrent reads and writes
-        conn.execute('PRAGMA journal_mode=WAL;')
 
+    The connection is returned rather than closed, so that the page cache and the statement cache stay warm
+    across capture cycles. Its rows are `sqlite3.Row` objects, which support access by column name.
+    """
+    # Connect to the SQLite database at the provided path, rows can be accessed by column name
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+
+    # Enable Write-Ahead Logging (WAL) mode to improve performance and allow concurrent reads and writes,
+    # the remaining settings only apply to this connection
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA busy_timeout=5000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+    ''')
+
+    with conn:
         # Create a cursor object to interact with the database
         cursor = conn.cursor()
 
@@ -30,7 +65,7 @@ def initialize_database(db_path):
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS filestatus (
             ID INTEGER PRIMARY KEY AUTOINCREMENT,  -- Unique ID for each file entry
-            filename TEXT NOT NULL UNIQUE,  -- The name of the file (must be unique)
+            filename TEXT NOT NULL UNIQUE,  -- The name of the file (must be unique, indexed by the constraint)
             GCPstatus INTEGER NOT NULL DEFAULT 0,  -- Status of file upload to Google Cloud Platform (0 = not uploaded, 1 = uploaded)
             AWSstatus INTEGER NOT NULL DEFAULT 0,  -- Status of file upload to Amazon Web Services (0 = not uploaded, 1 = uploaded)
             NASstatus INTEGER NOT NULL DEFAULT 0,  -- Status of file copy to Network-Attached Storage (0 = not copied, 1 = copied)
@@ -47,65 +82,79 @@ def initialize_database(db_path):
         )
         ''')
 
-        # Commit the transaction to save changes to the database
-        conn.commit()
+        # Index only the files still missing in a cloud, get_unuploaded_files scans this instead of the table
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_unuploaded ON filestatus(ID) WHERE AWSstatus = 0 OR GCPstatus = 0
+        ''')
+
+    return conn
+
+
+def maintain_database(conn, optimize=False):
+    """
+    Checkpoints the write-ahead log and optionally refreshes the query planner statistics.
+
+    Args:
+    conn (sqlite3.Connection): The long-lived database connection from `initialize_database`.
+    optimize (bool, optional): Whether to also run `PRAGMA optimize` (default is False).
 
+    Returns:
+    None
 
-def execute_db_operation(operation, cursor, *args, retries=5, delay=1):
+    With a connection that stays open, the WAL file is only checkpointed automatically and can keep growing while
+    it is being read. A passive checkpoint copies the committed pages back into the database without waiting
+    for other connections. `PRAGMA optimize` runs ANALYZE where the statistics are out of date, so it only
+    needs to run about once a day. Errors are logged, maintenance is retried on the next call.
     """
-    Executes a database operation with retries if the database is locked or an operational error occurs.
+    try:
+        conn.execute('PRAGMA wal_checkpoint(PASSIVE);')
+        if optimize:
+            conn.execute('PRAGMA optimize;')
+    except sqlite3.Error as e:
+        logging.error(f"Database maintenance failed: {e}.")
+
+
+def execute_db_operation(operation, cursor, *args, commit=True):
+    """
+    Executes a database operation and commits the transaction.
 
     Args:
     operation (function): The database operation function to be executed.
     cursor (sqlite3.Cursor): The database cursor used to execute the operation.
     *args: Arguments to pass to the operation function.
-    retries (int, optional): The number of retries if the operation fails due to a locked database (default is 5).
-    delay (int, optional): The delay in seconds between retries if the database is locked (default is 1 second).
+    commit (bool, optional): Whether to commit the transaction (default is True). Pass False to group
+                             several operations into one transaction, committed by the last of them.
 
     Returns:
     None
 
     The function attempts to execute the provided database operation and commits the transaction.
-    If the database is locked, it retries the operation up to the specified number of retries.
-    If an exception occurs, it logs the error, sends an email notification, and stops further attempts.
+    A locked database is waited for by SQLite itself, up to the busy timeout set in `initialize_database`,
+    so the operation is not retried here. If an operational error occurs (including a database still locked
+    after the timeout), it logs the error. If any other exception occurs, it logs the error and sends
+    an email notification.
     """
-    for attempt in range(retries):
-        try:
-            # Attempt to execute the provided operation with the given arguments
-            operation(cursor, *args)
+    try:
+        # Execute the provided operation with the given arguments
+        operation(cursor, *args)
 
-            # Commit the transaction to save the changes in the database
+        # Commit the transaction to save the changes in the database
+        if commit:
             cursor.connection.commit()
-            return  # Exit the function if the operation is successful
-
-        except sqlite3.OperationalError as e:
-            # Check if the error is due to the database being locked
-            if "database is locked" in str(e):
-                # Log a warning and wait before retrying
-                logging.warning(f"Database is locked. Retrying in {delay} seconds... (Attempt {attempt + 1}/{retries})")
-                time.sleep(delay)
-            else:
-                # Log the error and stop further attempts if it's a different operational error
-                logging.error(f"Database operation failed: {e}.")
-                return
-
-        except Exception as e:
-            # Log the error and send an email notification for any non-operational errors
-            logging.error(f"An error occurred during the database operation: {e}.")
-            subject = 'An error occurred during the database operation'
-            body = f"An error occurred during the database operation: {e}."
-            send_email(subject, body)
-            return
-
-    # If the maximum number of retries is reached, log the failure and send an email notification
-    logging.error("Maximum retries reached. Database operation failed.")
-    subject = 'Database Operation Failed'
-    body = "An error occurred during the database operation. Maximum retries reached."
-    send_email(subject, body)
-    return
-
-
-def insert_file_record(cursor, filename, filetype, local_destination):
+
+    except sqlite3.OperationalError as e:
+        # Log the error, SQLite has already waited for the busy timeout if the database was locked
+        logging.error(f"Database operation failed: {e}.")
+
+    except Exception as e:
+        # Log the error and send an email notification for any non-operational errors
+        logging.error(f"An error occurred during the database operation: {e}.")
+        subject = 'An error occurred during the database operation'
+        body = f"An error occurred during the database operation: {e}."
+        send_email(subject, body)
+
+
+def insert_file_record(cursor, filename, filetype, local_destination, file_datetime=None):
     """
     Inserts a new file record into the 'filestatus' table.
 
@@ -114,6 +163,8 @@ def insert_file_record(cursor, filename, filetype, local_destination):
     filename (str): The name of the file to be inserted into the database.
     filetype (str): The type of the file (e.g., image, video).
     local_destination (str): The local path where the file is stored.
+    file_datetime (str, optional): The datetime of the file as 'YYYY-MM-DD HH:MM:SS'. Extracted from the filename
+                                   if not given, callers that already extracted it can pass it in.
 
     Returns:
     None
@@ -123,13 +174,11 @@ def insert_file_record(cursor, filename, filetype, local_destination):
     """
     try:
         # Extract the datetime from the filename using the custom function extract_datetime_from_filename
-        file_datetime, _, _ = extract_datetime_from_filename(filename)
+        if file_datetime is None:
+            file_datetime, _, _ = extract_datetime_from_filename(filename)
 
         # Insert the new file record into the 'filestatus' table
-        cursor.execute('''
-            INSERT INTO filestatus (filename, filetype, localstatus, localdestination, datetime)
-            VALUES (?, ?, 1, ?, ?)
-        ''', (filename, filetype, local_destination, file_datetime))
+        cursor.execute(_SQL_INSERT_FILE, (filename, filetype, local_destination, file_datetime))
 
     except Exception as e:
         # Log the error and prepare an email notification in case of an exception
@@ -139,6 +188,35 @@ def insert_file_record(cursor, filename, filetype, local_destination):
         send_email(subject, body)
 
 
+def insert_file_records(cursor, records):
+    """
+    Inserts several new file records into the 'filestatus' table in a single statement.
+
+    Args:
+    cursor (sqlite3.Cursor): The database cursor used to execute the SQL command.
+    records (list): A list of (filename, filetype, local_destination, file_datetime) tuples, with the datetime
+                    as extracted by `extract_datetime_from_filename`.
+
+    Returns:
+    None
+
+    This function inserts the same fields as `insert_file_record` for every record using `executemany`,
+    so that the files of a capture cycle are written with a single commit.
+
+    If an exception occurs, it logs the error and sends an email notification.
+    """
+    try:
+        # Insert the new file records into the 'filestatus' table
+        cursor.executemany(_SQL_INSERT_FILE, records)
+
+    except Exception as e:
+        # Log the error and prepare an email notification in case of an exception
+        logging.error(f"An error occurred while inserting file records: {e}")
+        subject = 'An error occurred while inserting file records'
+        body = f"An error occurred while inserting file records: {e}"
+        send_email(subject, body)
+
+
 def update_file_record_aws(cursor, filename, aws_destination, bucket_name, data_integrityAWS):
     """
     Updates the AWS-related fields of a file record in the 'filestatus' table.
@@ -164,11 +242,7 @@ def update_file_record_aws(cursor, filename, aws_destination, bucket_name, data_
     """
     try:
         # Execute the SQL command to update the AWS-related fields for the given filename
-        cursor.execute('''
-        UPDATE filestatus
-        SET AWSstatus = ?, AWSdestination = ?, AWSbucketname = ?, dataintegrityAWS = ?
-        WHERE filename = ?
-        ''', (1, aws_destination, bucket_name, data_integrityAWS, filename))
+        cursor.execute(_SQL_UPDATE_AWS, (aws_destination, bucket_name, data_integrityAWS, filename))
 
     except Exception as e:
         # Log the error and prepare an email notification in case of an exception
@@ -203,11 +277,7 @@ def update_file_record_gcp(cursor, filename, gcp_destination, bucket_name, data_
     """
     try:
         # Execute the SQL command to update the GCP-related fields for the given filename
-        cursor.execute('''
-        UPDATE filestatus
-        SET GCPstatus = ?, GCPdestination = ?, GCPbucketname = ?, dataintegrityGCP = ?
-        WHERE filename = ?
-        ''', (1, gcp_destination, bucket_name, data_integrityGCP, filename))
+        cursor.execute(_SQL_UPDATE_GCP, (gcp_destination, bucket_name, data_integrityGCP, filename))
 
     except Exception as e:
         # Log the error and prepare an email notification in case of an exception
@@ -215,3 +285,67 @@ def update_file_record_gcp(cursor, filename, gcp_destination, bucket_name, data_
         subject = 'An error occurred while updating file record (GCP)'
         body = f"An error occurred while updating file record (GCP): {e}"
         send_email(subject, body)
+
+
+def update_file_records_aws(cursor, records):
+    """
+    Updates the AWS-related fields of several file records in the 'filestatus' table in a single statement.
+
+    Args:
+    cursor (sqlite3.Cursor): The database cursor used to execute the SQL command.
+    records (list): A list of (filename, aws_destination, bucket_name, data_integrityAWS) tuples.
+
+    Returns:
+    None
+
+    This function sets the same fields as `update_file_record_aws` for every record using `executemany`,
+    so that a batch of uploads is written with a single commit.
+
+    If an exception occurs, it logs the error and sends an email notification.
+    """
+    try:
+        # Order the fields of each record as the placeholders of the SQL command
+        parameters = [(aws_destination, bucket_name, data_integrityAWS, filename)
+                      for filename, aws_destination, bucket_name, data_integrityAWS in records]
+
+        # Execute the SQL command to update the AWS-related fields for every given filename
+        cursor.executemany(_SQL_UPDATE_AWS, parameters)
+
+    except Exception as e:
+        # Log the error and prepare an email notification in case of an exception
+        logging.error(f"An error occurred while updating file records AWS status: {e}")
+        subject = 'An error occurred while updating file records (AWS)'
+        body = f"An error occurred while updating file records (AWS): {e}"
+        send_email(subject, body)
+
+
+def update_file_records_gcp(cursor, records):
+    """
+    Updates the GCP-related fields of several file records in the 'filestatus' table in a single statement.
+
+    Args:
+    cursor (sqlite3.Cursor): The database cursor used to execute the SQL command.
+    records (list): A list of (filename, gcp_destination, bucket_name, data_integrityGCP) tuples.
+
+    Returns:
+    None
+
+    This function sets the same fields as `update_file_record_gcp` for every record using `executemany`,
+    so that a batch of uploads is written with a single commit.
+
+    If an exception occurs, it logs the error and sends an email notification.
+    """
+    try:
+        # Order the fields of each record as the placeholders of the SQL command
+        parameters = [(gcp_destination, bucket_name, data_integrityGCP, filename)
+                      for filename, gcp_destination, bucket_name, data_integrityGCP in records]
+
+        # Execute the SQL command to update the GCP-related fields for every given filename
+        cursor.executemany(_SQL_UPDATE_GCP, parameters)
+
+    except Exception as e:
+        # Log the error and prepare an email notification in case of an exception
+        logging.error(f"An error occurred while updating file records GCP status: {e}")
+        subject = 'An error occurred while updating file records (GCP)'
+        body = f"An error occurred while updating file records (GCP): {e}"
+        send_email(subject, body)
@@ -1,106 +1,136 @@
-import configparser
 import pytz
 import os
 import boto3
-import sqlite3
+from botocore.config import Config
 import logging
+import logging.handlers
 import time
-from databasewrite import (initialize_database, execute_db_operation, insert_file_record, update_file_record_gcp,
-                           update_file_record_aws)
+from concurrent.futures import ThreadPoolExecutor
+from databasewrite import (initialize_database, execute_db_operation, insert_file_records, update_file_records_gcp,
+                           update_file_records_aws, maintain_database)
 from network import send_email, check_internet_connectivity, disconnect_current_wifi
 from cloudupload import upload_files_to_cloud, upload_unuploaded_files
-from utils import get_next_capture_time, extract_datetime_from_filename
-from Capture import capture_image, capture_video
+from AWSbucketmanager import get_s3_key
+from utils import get_next_capture_time, extract_datetime_from_filename, wait_for_stable_size
+from Capture import capture_image, capture_video, start_image_stream, get_h264_encoder
 from google.cloud import storage
 from datetime import datetime
 from Storagecleanup import delete_old_files
+from config import CFG
 
 
 def main_loop():
-    # Read configuration from config.ini
-    config = configparser.ConfigParser()
-    config.read('config.ini')
+    # Configuration read from config.ini
     mst = pytz.timezone('Etc/GMT+7')
     log_directory = 'logs'
     if not os.path.exists(log_directory):
         os.makedirs(log_directory)
 
-    aws_upload = config.getboolean('platform', 'aws')
-    gcp_upload = config.getboolean('platform', 'gcp')
+    aws_upload = CFG.aws_upload
+    gcp_upload = CFG.gcp_upload
 
-    AWS_image_bucket_name = config['aws']['image_bucket_name'] if aws_upload else None
-    AWS_video_bucket_name = config['aws']['video_bucket_name'] if aws_upload else None
+    AWS_image_bucket_name = CFG.aws_image_bucket_name if aws_upload else None
+    AWS_video_bucket_name = CFG.aws_video_bucket_name if aws_upload else None
+    # Let boto3 retry throttling and transient errors with adaptive backoff
     s3_client = boto3.client('s3',
-                             aws_access_key_id=config['aws']['aws_access_key_id'],
-                             aws_secret_access_key=config['aws']['aws_secret_access_key']) if aws_upload else None
+                             aws_access_key_id=CFG.aws_access_key_id,
+                             aws_secret_access_key=CFG.aws_secret_access_key,
+                             config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'})) if aws_upload else None
 
-    GCP_image_bucket_name = config['gcp']['image_bucket_name'] if gcp_upload else None
-    GCP_video_bucket_name = config['gcp']['video_bucket_name'] if gcp_upload else None
-    gcs_client = storage.Client.from_service_account_json(config['gcp']['service_account_json']) if gcp_upload else None
+    GCP_image_bucket_name = CFG.gcp_image_bucket_name if gcp_upload else None
+    GCP_video_bucket_name = CFG.gcp_video_bucket_name if gcp_upload else None
+    gcs_client = storage.Client.from_service_account_json(CFG.gcp_service_account_json) if gcp_upload else None
 
-    rtsp_url = config['camera']['address']
+    rtsp_url = CFG.camera_address
+    transcode = CFG.camera_transcode
+    resize = CFG.camera_resize
+    persistent_stream = CFG.camera_persistent_stream
 
     # Directories and database path
-    image_base_directory = config['directories']['image_base_directory']
-    video_base_directory = config['directories']['video_base_directory']
-    db_path = config['database']['db_path']
-
-    # Run the database initialization
-    initialize_database(db_path=db_path)
-    current_day = datetime.now(mst).strftime('%Y-%m-%d')
-    log_file = os.path.join(log_directory, f'app_{current_day}.log')
-    logging.basicConfig(filename=log_file, level=logging.INFO,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+    image_base_directory = CFG.image_base_directory
+    video_base_directory = CFG.video_base_directory
+    db_path = CFG.db_path
+
+    # Run the database initialization, the connection is kept open for the lifetime of the process
+    conn = initialize_database(db_path=db_path)
+    cursor = conn.cursor()
+    # Log to logs/app.log, rotated at midnight into app.log.YYYY-MM-DD and kept for 30 days
+    log_file = os.path.join(log_directory, 'app.log')
+    log_handler = logging.handlers.TimedRotatingFileHandler(log_file, when='midnight', backupCount=30)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[log_handler])
+
+    # The log format does not include the thread or process, so do not collect them for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+
+    # Keep the camera stream open for image captures, if enabled
+    if persistent_stream:
+        start_image_stream(rtsp_url)
+
+    # Probe the video encoder once at startup
+    if transcode or resize:
+        get_h264_encoder()
+
+    # Uploads the image and the video of a cycle concurrently, each of them uploads to AWS and GCS in parallel
+    upload_executor = ThreadPoolExecutor(max_workers=2)
 
     while True:
-        today = datetime.now(mst).strftime('%Y-%m-%d')
-        if today != current_day:
-            for handler in logging.root.handlers[:]:
-                logging.root.removeHandler(handler)
-            log_file = os.path.join(log_directory, f'app_{today}.log')
-            logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-            current_day = today
-
         now = datetime.now(mst)
-        # Wait until the next capture time
-        next_capture_time = get_next_capture_time(mst=mst)
-        sleep_duration = (next_capture_time - datetime.now(mst)).total_seconds()
+        next_capture_time = get_next_capture_time(mst=mst, now=now)
+
+        # Keep the WAL file small, and refresh the planner statistics once a day together with the cleanup
+        maintain_database(conn, optimize=now.hour == 23 and now.minute < 30)
+
+        # Wait until the next capture time, measured after the maintenance
+        sleep_duration = max(0.0, (next_capture_time - datetime.now(mst)).total_seconds())
         logging.info(f"Sleeping for {sleep_duration} seconds")
         time.sleep(sleep_duration)
 
         # Capture Image and Video
-        image_path, image_filename = capture_image(rtsp_url, image_base_directory, timezone=mst)
-        video_path, video_filename = capture_video(rtsp_url, video_base_directory, mst, duration=40)
-
-        time.sleep(20)
-
-        if not image_filename or video_filename:
+        image_path, image_filename = capture_image(rtsp_url, image_base_directory, timezone=mst,
+                                                   persistent_stream=persistent_stream)
+        video_path, video_filename = capture_video(rtsp_url, video_base_directory, mst, duration=40,
+                                                   transcode=transcode, resize=resize)
+
+        # Make sure the video file is completely written before it is recorded and uploaded
+        if video_path:
+            wait_for_stable_size(video_path)
+
+        if not image_filename or not video_filename:
+            # Give the camera some time to recover before retrying a failed capture
+            time.sleep(20)
             if not image_filename:
                 logging.info('Retrying Capturing Image')
-                image_path, image_filename = capture_image(rtsp_url, image_base_directory, timezone=mst)
+                image_path, image_filename = capture_image(rtsp_url, image_base_directory, timezone=mst,
+                                                           persistent_stream=persistent_stream)
             if not video_filename:
                 logging.info('Retrying Capturing Video')
-                video_path, video_filename = capture_video(rtsp_url, video_base_directory, mst, duration=40)
+                video_path, video_filename = capture_video(rtsp_url, video_base_directory, mst, duration=40,
+                                                           transcode=transcode, resize=resize)
 
         if image_filename or video_filename:
-            # Extract year and month from the filename for folder structure
+            # Extract the datetime of each file once, the year and month for the folder structure
+            # are taken from the image if there is one, otherwise from the video
+            if video_filename:
+                video_datetime, year, month = extract_datetime_from_filename(video_filename)
             if image_filename:
-                _, year, month = extract_datetime_from_filename(image_filename)
-            else:
-                _, year, month = extract_datetime_from_filename(video_filename)
+                image_datetime, year, month = extract_datetime_from_filename(image_filename)
 
             try:
-                with sqlite3.connect(db_path) as conn:
-                    cursor = conn.cursor()
-
+                with conn:
+                    # Record the captured files in one commit before uploading, so that files whose upload
+                    # is interrupted are picked up by the upload of unuploaded files
+                    new_records = []
                     if image_filename:
-                        execute_db_operation(insert_file_record, cursor, image_filename, 'image', image_path)
+                        new_records.append((image_filename, 'image', image_path, image_datetime))
                     if video_filename:
-                        execute_db_operation(insert_file_record, cursor, video_filename, 'video', video_path)
+                        new_records.append((video_filename, 'video', video_path, video_datetime))
+                    execute_db_operation(insert_file_records, cursor, new_records)
 
-                    # Upload paths for S3 and GCS
-                    s3_image_path = f"{year}/{month}/{image_filename}"
-                    s3_video_path = f"{year}/{month}/{video_filename}"
+                    # Upload paths for S3 and GCS, a file that failed to capture has no S3 key
+                    s3_image_path = get_s3_key(image_filename, year, month) if image_filename else None
+                    s3_video_path = get_s3_key(video_filename, year, month) if video_filename else None
                     gcs_image_path = f"{year}/{month}/{image_filename}"
                     gcs_video_path = f"{year}/{month}/{video_filename}"
 
@@ -118,29 +148,44 @@ def main_loop():
                     # If the internet is working, proceed with the upload tasks
                     logging.info("Internet is working.")
 
-                    # Upload image to S3 and GCP
+                    # Upload status records of this cycle, written together after the uploads
+                    aws_records, gcp_records = [], []
+
+                    # Start the image and video uploads to S3 and GCP, they run concurrently
+                    if image_filename:
+                        image_future = upload_executor.submit(
+                            upload_files_to_cloud, image_path, image_filename, AWS_image_bucket_name,
+                            GCP_image_bucket_name, aws_upload, gcp_upload, s3_client, gcs_client)
+                    if video_filename:
+                        video_future = upload_executor.submit(
+                            upload_files_to_cloud, video_path, video_filename, AWS_video_bucket_name,
+                            GCP_video_bucket_name, aws_upload, gcp_upload, s3_client, gcs_client)
+
+                    # Collect the image upload status
                     if image_filename:
-                        aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP = upload_files_to_cloud(
-                            image_path, image_filename, AWS_image_bucket_name, GCP_image_bucket_name, aws_upload, gcp_upload, s3_client, gcs_client)
+                        aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP = image_future.result()
 
                         if aws_uploaded:
-                            execute_db_operation(update_file_record_aws, cursor, image_filename, s3_image_path,
-                                                 AWS_image_bucket_name, dataintegrityAWS)
+                            aws_records.append((image_filename, s3_image_path, AWS_image_bucket_name,
+                                                dataintegrityAWS))
                         if gcp_uploaded:
-                            execute_db_operation(update_file_record_gcp, cursor, image_filename, gcs_image_path,
-                                                 GCP_image_bucket_name, dataintegrityGCP)
+                            gcp_records.append((image_filename, gcs_image_path, GCP_image_bucket_name,
+                                                dataintegrityGCP))
 
-                    # Upload Video to S3 and GCP
+                    # Collect the video upload status
                     if video_filename:
-                        aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP = upload_files_to_cloud(
-                            video_path, video_filename, AWS_video_bucket_name, GCP_video_bucket_name, aws_upload, gcp_upload, s3_client, gcs_client)
+                        aws_uploaded, dataintegrityAWS, gcp_uploaded, dataintegrityGCP = video_future.result()
 
                         if aws_uploaded:
-                            execute_db_operation(update_file_record_aws, cursor, video_filename, s3_video_path,
-                                                 AWS_video_bucket_name, dataintegrityAWS)
+                            aws_records.append((video_filename, s3_video_path, AWS_video_bucket_name,
+                                                dataintegrityAWS))
                         if gcp_uploaded:
-                            execute_db_operation(update_file_record_gcp, cursor, video_filename, gcs_video_path,
-                                                 GCP_video_bucket_name, dataintegrityGCP)
+                            gcp_records.append((video_filename, gcs_video_path, GCP_video_bucket_name,
+                                                dataintegrityGCP))
+
+                    # Write the upload status of both files in a single commit
+                    execute_db_operation(update_file_records_aws, cursor, aws_records, commit=False)
+                    execute_db_operation(update_file_records_gcp, cursor, gcp_records)
 
                     # Upload any unuploaded files
                     upload_unuploaded_files(cursor, AWS_image_bucket_name, AWS_video_bucket_name, GCP_image_bucket_name,
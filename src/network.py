@@ -1,48 +1,124 @@
 import logging
-import requests
+import os
+import socket
 import subprocess
+import tempfile
 import boto3
-import configparser
+import atexit
+import functools
+import queue
+import threading
+import time
 from botocore.exceptions import ClientError
+from config import CFG
 
-def check_internet_connectivity(url='http://www.google.com', timeout=10):
+# Directory of the wpa_supplicant control sockets, one per interface
+WPA_CTRL_DIR = '/var/run/wpa_supplicant'
+
+# Seconds a connectivity check result is reused for
+CONNECTIVITY_CACHE_SECONDS = 15
+
+# Time (time.monotonic) and result of the last connectivity check
+_last_connectivity_check = (None, False)
+
+# Identical emails sent within this many seconds of each other are suppressed
+EMAIL_DEDUP_WINDOW = 300
+
+# Emails queued within this many seconds of the first one are sent together, one email per subject
+EMAIL_COALESCE_WINDOW = 60
+
+# Seconds to wait at exit for queued emails to be sent
+EMAIL_FLUSH_TIMEOUT = 30
+
+# Emails waiting to be sent by the background thread, and when each (subject, body) was last queued
+_email_queue = queue.Queue()
+_email_last_sent = {}
+_email_lock = threading.Lock()
+_email_thread = None
+
+def check_internet_connectivity(host='8.8.8.8', port=53, timeout=2, max_age=CONNECTIVITY_CACHE_SECONDS):
     """
-    Checks internet connectivity by sending a request to a specified URL.
+    Checks internet connectivity by opening a TCP connection to a well-known host.
 
     Args:
-    url (str): The URL to send the request to. Defaults to 'http://www.google.com'.
-    timeout (int): The timeout duration for the request in seconds. Defaults to 10 seconds.
+    host (str): The host to connect to. Defaults to '8.8.8.8' (Google Public DNS).
+    port (int): The TCP port to connect to. Defaults to 53.
+    timeout (int): The timeout duration for the connection in seconds. Defaults to 2 seconds.
+    max_age (int): The number of seconds a previous result is reused for. Defaults to `CONNECTIVITY_CACHE_SECONDS`.
 
     Returns:
-    bool: True if the request is successful and the status code is 200, False otherwise.
+    bool: True if the connection could be opened, False otherwise.
 
-    This function attempts to send a GET request to the specified URL. If the request is successful and
-    the response status code is 200 (OK), it returns True, indicating that internet connectivity is present.
-    If there is any issue with the request (e.g., timeout or connection error), it returns False.
+    This function attempts to open a TCP connection to the specified host and port, without DNS lookup, TLS or HTTP.
+    If the connection is established, it returns True, indicating that internet connectivity is present.
+    If there is any issue with the connection (e.g., timeout or unreachable network), it returns False.
+    The result is cached for `max_age` seconds, so checks in quick succession (e.g. a burst of emails) do not
+    each wait for the timeout while offline.
 
     Example:
     >>> check_internet_connectivity()
     True
-    >>> check_internet_connectivity(url='http://nonexistentwebsite.com')
+    >>> check_internet_connectivity(host='10.255.255.1', max_age=0)
     False
     """
+    global _last_connectivity_check
+
+    # Reuse a recent result
+    checked_at, connected = _last_connectivity_check
+    now = time.monotonic()
+    if checked_at is not None and now - checked_at < max_age:
+        return connected
+
     try:
-        # Send a GET request to the specified URL with the given timeout
-        response = requests.get(url, timeout=timeout)
+        # Open and immediately close a TCP connection to the specified host
+        with socket.create_connection((host, port), timeout=timeout):
+            connected = True
+    except OSError:
+        # Return False if there is any issue with the connection
+        connected = False
 
-        # Return True if the response status code is 200, indicating successful connectivity
-        return response.status_code == 200
-    except requests.RequestException:
-        # Return False if there is any issue with the request
-        return False
+    _last_connectivity_check = (time.monotonic(), connected)
+    return connected
+
+
+def _wpa_ctrl_request(command, interface='wlan0', timeout=5):
+    """
+    Sends a command to wpa_supplicant over its control socket.
+
+    Args:
+    command (str): The control interface command (e.g. 'DISCONNECT').
+    interface (str): The wireless interface. Defaults to 'wlan0'.
+    timeout (int): The timeout for the reply in seconds. Defaults to 5 seconds.
+
+    Returns:
+    str: The reply of wpa_supplicant (e.g. 'OK').
+
+    Raises:
+    OSError: If the control socket does not exist, is not accessible or does not reply in time.
+
+    The control interface is a datagram Unix socket, the client binds its own socket so that wpa_supplicant
+    can send the reply back. Access requires membership in the group configured by `ctrl_interface_group`
+    (usually netdev), no sudo is needed.
+    """
+    local_path = os.path.join(tempfile.gettempdir(), f'wpa_ctrl_{os.getpid()}_{threading.get_ident()}')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.bind(local_path)
+        try:
+            sock.connect(os.path.join(WPA_CTRL_DIR, interface))
+            sock.send(command.encode())
+            return sock.recv(4096).decode().strip()
+        finally:
+            os.unlink(local_path)
 
 
 def disconnect_current_wifi():
     """
-    Disconnects from the current Wi-Fi network by running the appropriate system command.
+    Disconnects from the current Wi-Fi network through the wpa_supplicant control interface.
 
-    This function uses the `wpa_cli` command-line tool to disconnect from the currently connected Wi-Fi network
-    on the `wlan0` interface. It requires elevated privileges (sudo) to execute the command.
+    This function sends a DISCONNECT command to wpa_supplicant on the `wlan0` interface over its control socket,
+    without starting a process. If the socket cannot be used (e.g. missing permissions), it falls back to the
+    `wpa_cli` command-line tool, which requires elevated privileges (sudo) to execute the command.
 
     Returns:
     None
@@ -53,6 +129,16 @@ def disconnect_current_wifi():
     >>> disconnect_current_wifi()
     Disconnected from the current Wi-Fi.
     """
+    try:
+        # Ask wpa_supplicant directly to disconnect from the current Wi-Fi network
+        reply = _wpa_ctrl_request('DISCONNECT')
+        if reply == 'OK':
+            logging.info("Disconnected from the current Wi-Fi.")
+            return
+        logging.warning(f"Unexpected reply from wpa_supplicant: {reply}")
+    except OSError as e:
+        logging.warning(f"wpa_supplicant control interface not available, using wpa_cli: {e}")
+
     try:
         # Run the command to disconnect from the current Wi-Fi network
         subprocess.run(['sudo', 'wpa_cli', '-i', 'wlan0', 'disconnect'], check=True)
@@ -64,7 +150,143 @@ def disconnect_current_wifi():
 
 def send_email(subject, body):
     """
-    Sends an email using AWS SES.
+    Queues an email to be sent in the background using AWS SES.
+
+    Args:
+    subject (str): The subject of the email.
+    body (str): The body of the email.
+
+    Returns:
+    None
+
+    The email is sent by a background thread (see `_send_email_now`), so the capture and upload paths do not
+    wait for the connectivity check and the SES request, which are slowest exactly during the network outages
+    that trigger most notifications. An email identical to one queued within the last `EMAIL_DEDUP_WINDOW`
+    seconds is dropped, so a backlog of files failing for the same reason does not flood the mailbox.
+    Emails with the same subject queued within `EMAIL_COALESCE_WINDOW` seconds are combined into one.
+
+    Example:
+    >>> send_email('Upload to S3', 'Error uploading /path/to/file.jpg to S3: ...')
+    """
+    global _email_thread
+
+    with _email_lock:
+        # Drop duplicates of a recent email
+        now = time.monotonic()
+        last_sent = _email_last_sent.get((subject, body))
+        if last_sent is not None and now - last_sent < EMAIL_DEDUP_WINDOW:
+            logging.info(f"Suppressed duplicate email: {subject}")
+            return
+        _email_last_sent[(subject, body)] = now
+
+        # Forget emails outside the window, so the dictionary does not grow with every distinct message
+        for key in [key for key, sent in _email_last_sent.items() if now - sent >= EMAIL_DEDUP_WINDOW]:
+            del _email_last_sent[key]
+
+        # Start the sender thread on first use
+        if _email_thread is None:
+            _email_thread = threading.Thread(target=_email_worker, daemon=True)
+            _email_thread.start()
+
+    _email_queue.put_nowait((subject, body))
+
+
+def _coalesce_emails(emails):
+    """
+    Combines queued emails with the same subject into a single email.
+
+    Args:
+    emails (list): A list of (subject, body) tuples in the order they were queued.
+
+    Returns:
+    list: A list of (subject, body) tuples, one per distinct subject.
+
+    Example:
+    >>> _coalesce_emails([('Upload to S3', 'a'), ('Upload to S3', 'b')])
+    [('Upload to S3 (2 notifications)', 'a\n\nb')]
+    """
+    bodies_by_subject = {}
+    for subject, body in emails:
+        bodies_by_subject.setdefault(subject, []).append(body)
+
+    coalesced = []
+    for subject, bodies in bodies_by_subject.items():
+        if len(bodies) == 1:
+            coalesced.append((subject, bodies[0]))
+        else:
+            coalesced.append((f"{subject} ({len(bodies)} notifications)", '\n\n'.join(bodies)))
+    return coalesced
+
+
+def _email_worker():
+    """
+    Sends the queued emails until a None sentinel is received.
+
+    After the first email of a batch, the worker keeps collecting emails for `EMAIL_COALESCE_WINDOW` seconds
+    and then sends one email per subject.
+    """
+    stopped = False
+    while not stopped:
+        item = _email_queue.get()
+        if item is None:
+            break
+
+        # Collect the emails queued during the coalescing window
+        batch = [item]
+        deadline = time.monotonic() + EMAIL_COALESCE_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _email_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Send what was collected before stopping
+                stopped = True
+                break
+            batch.append(item)
+
+        for subject, body in _coalesce_emails(batch):
+            try:
+                _send_email_now(subject, body)
+            except Exception as e:
+                # Keep the thread alive, a failed notification must not stop the following ones
+                logging.error(f"Error sending email: {e}")
+
+
+def _flush_emails():
+    """
+    Waits up to `EMAIL_FLUSH_TIMEOUT` seconds at exit for the queued emails to be sent.
+    """
+    if _email_thread is not None:
+        _email_queue.put(None)
+        _email_thread.join(EMAIL_FLUSH_TIMEOUT)
+
+
+atexit.register(_flush_emails)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_ses_client():
+    """
+    Creates the AWS SES client used for sending emails, once per process.
+
+    Returns:
+    boto3.client: The SES client.
+
+    Creating a boto3 client loads the service model and takes a noticeable amount of time, so the client is reused
+    for every email. boto3 clients are thread safe.
+    """
+    return boto3.client('ses', region_name='us-west-1',
+                        aws_access_key_id=CFG.aws_access_key_id,
+                        aws_secret_access_key=CFG.aws_secret_access_key)
+
+
+def _send_email_now(subject, body):
+    """
+    Sends an email using AWS SES, blocking until the request completes.
 
     Args:
     subject (str): The subject of the email.
@@ -74,23 +296,19 @@ def send_email(subject, body):
     None
 
     This function uses AWS Simple Email Service (SES) to send an email. The configuration details
-    (AWS credentials and email addresses) are read from a 'config.ini' file.
+    (AWS credentials and email addresses) are taken from the shared configuration (`config.CFG`).
+    The SES client is created on the first email and reused afterwards.
     """
     if not check_internet_connectivity():
         print("No Internet connectivity.")
         return
-        
-    config = configparser.ConfigParser()
-    config.read('config.ini')
 
-    ses_client = boto3.client('ses', region_name='us-west-1',
-                              aws_access_key_id=config['aws']['aws_access_key_id'],
-                              aws_secret_access_key=config['aws']['aws_secret_access_key'])
-    to_email = config['email']['receiver']
+    ses_client = _get_ses_client()
+    to_email = CFG.email_receiver
 
     try:
         response = ses_client.send_email(
-            Source=config['email']['source'],  # Replace with your verified email
+            Source=CFG.email_source,  # Replace with your verified email
             Destination={
                 'ToAddresses': [to_email]
             },
@@ -1,6 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
+import os
+import time
 from datetime import datetime, timedelta
 import hashlib
+import mmap
+import re
+
+# The block size for reading files that are hashed without memory-mapping them
+HASH_BLOCK_SIZE = 1 << 20  # 1 MiB
+
+# The capture datetime in a filename, e.g. "_2024-08-09_14-30-00." in "image_capture_2024-08-09_14-30-00.jpg"
+_DT_RE = re.compile(r'_(\d{4}-\d{2}-\d{2})_(\d{2}-\d{2}-\d{2})\.')
+
+# A hexadecimal MD5 checksum, or an S3 multipart ETag with the number of parts appended
+_HEX_MD5_RE = re.compile(r'[0-9a-f]{32}(-\d+)?')
+
+# The full month names indexed by month number, independent of the locale
+_MONTHS = ('', 'January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+           'November', 'December')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime_from_filename(filename):
+    """
+    Parses the datetime, year, and month from the filename, see `extract_datetime_from_filename`.
+
+    Args:
+    filename (str): The name of the file.
+
+    Returns:
+    tuple or None: The datetime string, year and month name, or None if the filename does not contain a datetime.
+
+    Raises:
+    ValueError: If the datetime in the filename is not a valid date and time (e.g. February 30).
+
+    This is the pure part of the extraction, so its results are cached per filename, which saves parsing the
+    same name again on the upload, retry and cleanup paths. Exceptions are not cached.
+    """
+    # Match the date and time parts (e.g., "2024-08-09" and "14-30-00")
+    match = _DT_RE.search(filename)
+    if match is None:
+        return None
+    date_str, time_str = match.groups()
+
+    # Parse and validate the date and time with the C implemented ISO parser, e.g. reject a month 13
+    datetime_obj = datetime.fromisoformat(f"{date_str} {time_str.replace('-', ':')}")
+
+    # Return the formatted datetime string, year, and full month name (e.g., "August"), without strftime
+    return datetime_obj.isoformat(sep=' ', timespec='seconds'), str(datetime_obj.year), _MONTHS[datetime_obj.month]
 
 
 def extract_datetime_from_filename(filename):
@@ -19,41 +68,40 @@ def extract_datetime_from_filename(filename):
            If extraction fails, returns (None, None, None).
 
     The function assumes that the filename contains a datetime in the format "YYYY-MM-DD_HH-MM-SS".
-    It extracts the date and time parts, combines them, and converts them into a datetime object.
-    The year and month are then extracted from this object.
+    The date and time parts are matched with a precompiled regular expression and parsed with
+    `datetime.fromisoformat`, which is implemented in C and much cheaper than splitting the filename and parsing
+    it with `strptime`.
+    The month name is looked up in `_MONTHS` rather than formatted with the locale dependent `strftime('%B')`.
+
+    If the filename does not contain a valid datetime, the function logs the error and returns None values.
+    Other errors, e.g. a filename that is not a string, are not caught and propagate to the caller.
 
-    If an error occurs during extraction, the function logs the error and returns None values.
+    The parsing itself is done by the cached `_parse_datetime_from_filename`, so parsing the same name again is a
+    dictionary lookup while invalid filenames are still logged on every call.
     """
     try:
-        # Split the filename to extract the date and time parts
-        date_str = filename.split('_')[2]  # Extract date part (e.g., "2024-08-09")
-        time_str = filename.split('_')[3].split('.')[0]  # Extract time part (e.g., "14-30-00")
-
-        # Combine date and time parts, and replace dashes in time with colons
-        datetime_str = f"{date_str} {time_str.replace('-', ':')}"
-
-        # Convert the combined string into a datetime object
-        datetime_obj = datetime.strptime(datetime_str, '%Y-%m-%d %H:%M:%S')
-
-        # Extract year and month from the datetime object
-        year = datetime_obj.strftime('%Y')  # Extract year (e.g., "2024")
-        month = datetime_obj.strftime('%B')  # Extract full month name (e.g., "August")
-
-        # Return the formatted datetime string, year, and month
-        return datetime_obj.strftime('%Y-%m-%d %H:%M:%S'), year, month
+        result = _parse_datetime_from_filename(filename)
+    except ValueError as e:
+        # Log the impossible date or time and return None values
+        logging.error('Error extracting datetime from filename: %s', e)
+        return None, None, None
 
-    except Exception as e:
-        # Log the error and return None values in case of an exception
-        logging.error(f'Error extracting datetime from filename: {e}')
+    if result is None:
+        # Log the malformed filename and return None values
+        logging.error('Error extracting datetime from filename: no datetime found in %s', filename)
         return None, None, None
 
+    return result
+
 
-def get_next_capture_time(mst):
+def get_next_capture_time(mst, now=None):
     """
     Calculates the next capture time rounded to the next 30-minute interval.
 
     Args:
     mst (datetime.tzinfo): The timezone information for the current datetime.
+    now (datetime, optional): The current time in `mst`, for callers that already have it
+                              (default is None, which uses `datetime.now(mst)`).
 
     Returns:
     datetime: The next capture time, rounded up to the nearest 30-minute interval.
@@ -66,18 +114,14 @@ def get_next_capture_time(mst):
     If the current time is 2024-08-26 14:23:45, the next capture time will be 2024-08-26 14:30:00.
     If the current time is 2024-08-26 14:30:00, the next capture time will be 2024-08-26 15:00:00.
     """
-    # Get the current time in the specified timezone
-    now = datetime.now(mst)
+    # Get the current time in the specified timezone, unless it was passed in
+    if now is None:
+        now = datetime.now(mst)
 
-    # Calculate the next 60-minute interval
-    minutes = 60
-    next_capture = now.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=minutes)
+    # Calculate the minute of the next 30-minute interval, carrying over into the next hour
+    add_hours, minute = divmod((now.minute // 30 + 1) * 30, 60)
 
-    # If the calculated time is earlier than or equal to the current time (in case now is exactly at the start of a 30-minute interval)
-    if next_capture <= now:
-        next_capture += timedelta(minutes=30)
-
-    return next_capture
+    return (now + timedelta(hours=add_hours)).replace(minute=minute, second=0, microsecond=0)
 
 
 def calculate_md5(file_path):
@@ -90,58 +134,163 @@ def calculate_md5(file_path):
     Returns:
     str: The MD5 checksum of the file as a hexadecimal string.
 
-    This function opens the specified file in binary mode and reads it in chunks of 4096 bytes.
-    It updates the MD5 hash object with each chunk and then returns the hexadecimal digest of the hash.
+    On Python 3.11+ the file is hashed with `hashlib.file_digest`, which reads it in large blocks and hashes
+    them in C without holding the GIL. On older versions the file is memory-mapped and passed to the MD5
+    hash object in a single call, so OpenSSL processes the whole file at once instead of small chunks. Files that
+    cannot be memory-mapped are read in blocks of `HASH_BLOCK_SIZE` bytes into a single reused buffer.
 
     Example:
     >>> calculate_md5('/path/to/file.txt')
     'd41d8cd98f00b204e9800998ecf8427e'
     """
-    # Create an MD5 hash object
-    md5_hash = hashlib.md5()
-
     # Open the file in binary mode
     with open(file_path, "rb") as f:
-        # Read the file in chunks of 4096 bytes
-        for byte_block in iter(lambda: f.read(4096), b""):
-            # Update the MD5 hash object with the bytes read
-            md5_hash.update(byte_block)
+        if hasattr(os, 'posix_fadvise'):
+            # The file is read once from start to end, let the kernel read ahead aggressively. The pages are not
+            # dropped afterwards with POSIX_FADV_DONTNEED, since the upload reads the file again right after hashing.
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+        if hasattr(hashlib, 'file_digest'):
+            # Read and hash the file entirely in C
+            return hashlib.file_digest(f, 'md5').hexdigest()
+
+        # Create an MD5 hash object
+        md5_hash = hashlib.md5()
+
+        try:
+            # Hash the memory-mapped file in a single call
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                md5_hash.update(mm)
+        except (ValueError, OSError):
+            # Empty or non-seekable files cannot be memory-mapped, read them in large blocks instead.
+            # Reading into the same buffer avoids allocating a new bytes object for every block.
+            buffer = bytearray(HASH_BLOCK_SIZE)
+            view = memoryview(buffer)
+            while size := f.readinto(buffer):
+                md5_hash.update(view[:size])
 
     # Return the hexadecimal digest of the MD5 hash
     return md5_hash.hexdigest()
 
 
-def data_integrity_check(file_path, cloud_md5):
+def calculate_multipart_etag(file_path, part_size, max_workers=None):
     """
-    Verifies the integrity of a file by comparing its local MD5 checksum with a provided cloud MD5 checksum.
+    Calculates the ETag that S3 assigns to a file uploaded as a multipart upload.
 
     Args:
-    file_path (str): The path to the local file for which the MD5 checksum is to be calculated.
-    cloud_md5 (str): The MD5 checksum of the file as provided by the cloud storage service.
+    file_path (str): The path to the file for which the ETag is to be calculated.
+    part_size (int): The size in bytes of each part used for the multipart upload.
+    max_workers (int, optional): The number of parts hashed in parallel (default is the number of CPUs).
 
     Returns:
-    bool: True if the local MD5 checksum matches the cloud MD5 checksum, False otherwise.
+    str: The multipart ETag in the form "<md5 of concatenated part digests>-<number of parts>".
 
-    This function calculates the MD5 checksum of the specified local file and compares it with the provided
-    cloud MD5 checksum. It logs an info message if the checksums match, indicating successful verification.
+    This function computes the MD5 digest of each `part_size` bytes of the file. The digests are concatenated and
+    hashed again, and the number of parts is appended, which is how S3 derives the ETag of an object uploaded in
+    multiple parts. Like `calculate_md5`, the file is memory-mapped so each part is hashed in a single call
+    without being copied. The parts are independent and hashlib releases the GIL while hashing them, so they are
+    hashed on several threads, which scales the hashing of long videos over all cores.
+
+    Example:
+    >>> calculate_multipart_etag('/path/to/video.mp4', 16 * 1024 * 1024)
+    'c3b1f1c9e4a5c5b1d7f5e2a9c1c9e0b2-3'
+    """
+    part_digests = []
+
+    # Open the file in binary mode
+    with open(file_path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                # Hash the file part by part, using the same boundaries as the multipart upload
+                offsets = range(0, len(view), part_size)
+                with ThreadPoolExecutor(max_workers=min(len(offsets), max_workers or os.cpu_count() or 1)) as executor:
+                    # The digests are returned in part order
+                    part_digests = list(executor.map(
+                        lambda offset: hashlib.md5(view[offset:offset + part_size]).digest(), offsets))
+        except ValueError:
+            # Empty files cannot be memory-mapped and have no parts
+            pass
+
+    # Hash the concatenated part digests and append the part count
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def data_integrity_check(local_md5, cloud_md5):
+    """
+    Verifies the integrity of an uploaded file by comparing its local checksum with the checksum reported by the cloud.
+
+    Args:
+    local_md5 (str): The hexadecimal checksum of the local file, calculated once before uploading
+                     (the MD5 checksum, or the multipart ETag for S3 multipart uploads).
+    cloud_md5 (str): The hexadecimal checksum of the file as provided by the cloud storage service (the S3 ETag).
+
+    Returns:
+    bool: True if the local checksum matches the cloud checksum, False otherwise.
+
+    The local checksum is passed in rather than calculated here, so that retried uploads of the same file do not
+    read and hash the file again. A missing or malformed cloud checksum fails the check right away, without
+    comparing it. GCS uploads are not checked here, the upload itself verifies their MD5 checksum (see `upload_to_gcs`).
+    It logs an info message if the checksums match, indicating successful verification.
     If the checksums do not match, it logs an error message indicating a verification failure.
 
     Example:
-    >>> data_integrity_check('/path/to/file.txt', 'd41d8cd98f00b204e9800998ecf8427e')
+    >>> data_integrity_check('d41d8cd98f00b204e9800998ecf8427e', 'd41d8cd98f00b204e9800998ecf8427e')
     True
     """
-    try:
-        # Calculate the MD5 checksum of the local file
-        local_md5 = calculate_md5(file_path)
+    if not cloud_md5:
+        logging.error("Upload verification failed! No MD5 checksum was reported by the cloud.")
+        return False
 
-        # Compare the local MD5 checksum with the cloud MD5 checksum
-        if local_md5 == cloud_md5:
-            logging.info("Upload verified successfully! MD5 checksums match.")
-            return True
-        else:
-            logging.error("Upload verification failed! MD5 checksums do not match.")
-            return False
-    except Exception as e:
-        # Log an error if there is an issue calculating the MD5 checksum
-        logging.error(f"Error during data integrity check: {e}")
+    if not _HEX_MD5_RE.fullmatch(cloud_md5):
+        logging.error("Upload verification failed! Invalid MD5 checksum: %r", cloud_md5)
         return False
+
+    # Compare the local MD5 checksum with the cloud MD5 checksum
+    if local_md5 == cloud_md5:
+        logging.info("Upload verified successfully! MD5 checksums match.")
+        return True
+    else:
+        logging.error("Upload verification failed! MD5 checksums do not match.")
+        return False
+
+
+def wait_for_stable_size(file_path, interval=0.25, timeout=20):
+    """
+    Waits until a file stops growing.
+
+    Args:
+    file_path (str): The path of the file to watch.
+    interval (float, optional): The seconds between two size checks (default is 0.25 seconds).
+    timeout (float, optional): The maximum number of seconds to wait (default is 20 seconds).
+
+    Returns:
+    bool: True if the size was unchanged for two consecutive checks, False if the timeout was reached
+          or the file does not exist.
+
+    Used after a capture instead of a fixed delay, so that the file is not read while it is still being written,
+    without waiting longer than necessary when it is already complete.
+
+    Example:
+    >>> wait_for_stable_size('/path/to/video.mp4')
+    True
+    """
+    deadline = time.monotonic() + timeout
+    previous_size = None
+    stable_checks = 0
+
+    while time.monotonic() < deadline:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return False
+
+        # Count the consecutive checks with an unchanged size
+        stable_checks = stable_checks + 1 if size == previous_size else 0
+        if stable_checks >= 2:
+            return True
+        previous_size = size
+        time.sleep(interval)
+
+    logging.warning("%s was still changing after %s seconds", file_path, timeout)
+    return False